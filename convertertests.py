@@ -1,91 +1,38 @@
+import os
+import random
+import time
 import unittest
-import wstomwconverter
-
-class OptionsContainer:
-    pass
+import wstomdconverter
+import wstomddiff
+import wstomdservice
 
 class TestConverter(unittest.TestCase):
-    def setUp(self):    
+    def setUp(self):
         filepath = "./test.tmp"
         open(filepath, 'w').write('junk')
-    
-        options = OptionsContainer()
-        options.debug=False
-        options.usemedia=False
-        options.filelocation="http://localhost/files/"
-        
-        self.converter = wstomwconverter.WikispacesToMediawikiConverter(filepath, 
-                        options)
-    
-    def test_bold_simple(self):
-        self.source_wikitext = \
-"""
-A paragraph with **some bold text** in it.
 
-Some **multiline 
-bold text**
-"""
-        self.target_wikitext = \
-"""
-A paragraph with '''some bold text''' in it.
+        options = {'debug': False,
+                   'filelocation': "http://localhost/files/%s"}
 
-Some '''multiline 
-bold text'''
-"""
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.converter = wstomdconverter.WikispacesToMarkdownConverter(filepath,
+                        options)
 
-    def test_bold_lists(self):
-        self.source_wikitext = \
-"""
-* level 1 list item **some bold text**
-** level 2 list item **some bold text**
-*** level 3 list item **some bold text**
-**** level 4 list item **some bold text** **more bold text**
-"""
-        self.target_wikitext = \
-"""
-* level 1 list item '''some bold text'''
-** level 2 list item '''some bold text'''
-*** level 3 list item '''some bold text'''
-**** level 4 list item '''some bold text''' '''more bold text'''
-"""
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+    def tearDown(self):
+        os.remove("./test.tmp")
 
-    def test_bold_tricky(self):
-        self.source_wikitext = \
-"""
-Some tricky stuff: *****
-Wikispaces parses this as a bolded nothing with a star following it.
-"""
-        self.target_wikitext = \
-"""
-Some tricky stuff: ''''''*
-Wikispaces parses this as a bolded nothing with a star following it.
-"""
+    def convert(self):
         self.converter.content = self.source_wikitext
         self.converter.run_regexps()
         self.assertEqual(self.converter.content, self.target_wikitext)
 
-    def test_bold_line_start(self):
+    def test_bold_simple(self):
+        # Markdown uses the same markup
         self.source_wikitext = \
 """
-** Bulleted text has a space
-**No space is bold** text
-And extra ** are the just asterisks.
-"""
-        self.target_wikitext = \
-"""
-** Bulleted text has a space
-'''No space is bold''' text
-And extra ** are the just asterisks.
+A paragraph with **some bold text** in it.
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.target_wikitext = self.source_wikitext
+        self.convert()
 
     def test_italics_simple(self):
         self.source_wikitext = \
@@ -97,16 +44,14 @@ italicized// text.
 """
         self.target_wikitext = \
 """
-A paragraph with ''some italicized text'' in it.
+A paragraph with *some italicized text* in it.
 
-Some ''multiline
-italicized'' text.
+Some *multiline
+italicized* text.
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
-        
-    def test_italics_withurls(self):
+        self.convert()
+
+    def test_italics_urls(self):
         self.source_wikitext = \
 """
 A paragraph with //some italicized text// in it.
@@ -115,55 +60,33 @@ A paragraph with a url: http://www.google.com/
 """
         self.target_wikitext = \
 """
-A paragraph with ''some italicized text'' in it.
+A paragraph with *some italicized text* in it.
 
 A paragraph with a url: http://www.google.com/
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_underline(self):
+    def test_underline_simple(self):
         self.source_wikitext = \
 """
 A paragraph with __some underlined text__ in it.
-
-Some __multiline
-
-underlined__ text.
 """
         self.target_wikitext = \
 """
-A paragraph with <u>some underlined text</u> in it.
-
-Some <u>multiline
-
-underlined</u> text.
+A paragraph with _some underlined text_ in it.
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
-        
-    def test_monospaced(self):
+        self.convert()
+
+    def test_monospaced_simple(self):
         self.source_wikitext = \
 """
 A paragraph with {{some monospaced text}} in it.
-
-Some {{multiline
-
-monospaced}} text.
 """
         self.target_wikitext = \
 """
-A paragraph with <tt>some monospaced text</tt> in it.
-
-Some <tt>multiline
-
-monospaced</tt> text.
+A paragraph with `some monospaced text` in it.
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
     def test_variables(self):
         self.source_wikitext = \
@@ -174,125 +97,171 @@ A paragraph with {$page} in it.
 """
 A paragraph with test.tmp in it.
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-        
-    def test_includes(self):
+    def test_toc(self):
         self.source_wikitext = \
 """
-A paragraph.
-
-[[include page="somepage"]]
-
-[[include page="somepage" title="some title"]]
+A paragraph...
 
-[[include page="somepage" editable="true"]]
+[[toc]]
 
-[[include page="somepage" wrap="true"]]
+[[toc|flat]]
 """
         self.target_wikitext = \
 """
-A paragraph.
-
-{{:somepage}}
-
-{{:somepage}}
+A paragraph...
 
-{{:somepage}}
 
-{{:somepage}}
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_toc(self):
+    def test_headings(self):
         self.source_wikitext = \
 """
-A paragraph...
+= Heading 1 =
+text
+== Heading 2 ==
+text
+"""
+        self.target_wikitext = \
+"""
+# Heading 1
+text
+## Heading 2
+text
+"""
+        self.convert()
 
-[[toc]]
+    def test_headings_adjacent(self):
+        self.source_wikitext = \
+"""
+== Heading 2 ==
+=== Heading 3 ===
 
-[[toc|flat]]
+== Heading 2 again ==
 """
         self.target_wikitext = \
 """
-A paragraph...
-
+## Heading 2
+### Heading 3
 
+## Heading 2 again
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_external_links(self):
+    def test_toc_generated(self):
+        self.converter = wstomdconverter.WikispacesToMarkdownConverter("./test.tmp", {'toc': True})
         self.source_wikitext = \
 """
-A paragraph with [[http://example.com|an external link]].
+[[toc]]
+= Intro =
+Jump [[#here]] or [[toc|flat]]
+== Some Details ==
+== Some Details ==
+"""
+        self.target_wikitext = \
+"""
+* [Intro](#intro)
+  * [Some Details](#some-details)
+  * [Some Details](#some-details-1)
 
-Another paragraph with [[https://example.com|an external link]].
+# Intro
+Jump <a id="here"></a> or [Intro](#intro) | [Some Details](#some-details) | [Some Details](#some-details-1)
+## Some Details
+## Some Details
+"""
+        self.convert()
+        self.assertEqual([(heading['level'], heading['slug']) for heading in self.converter.outline],
+                         [(1, 'intro'), (2, 'some-details'), (2, 'some-details-1')])
 
-Yet another paragraph with [[ftp://example.com|an external link]].
+    def test_toc_headings_with_markup(self):
+        self.converter = wstomdconverter.WikispacesToMarkdownConverter("./test.tmp", {'toc': True})
+        self.source_wikitext = \
+"""
+= See [[Other Page|x]] =
+[[toc]]
+text
+== Title [[#t]] **bold** ==
 """
         self.target_wikitext = \
 """
-A paragraph with [http://example.com an external link].
+# See [x](Other Page)
 
-Another paragraph with [https://example.com an external link].
+* [See x](#see-x)
+  * [Title bold](#title-bold)
 
-Yet another paragraph with [ftp://example.com an external link].
+text
+## Title <a id="t"></a> **bold**
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
+        self.assertEqual([(heading['level'], heading['text']) for heading in self.converter.outline],
+                         [(1, 'See x'), (2, 'Title bold')])
 
-    def test_naked_external_links(self):
+    def test_lists(self):
         self.source_wikitext = \
 """
-A paragraph with a [[http://example.com]] naked external link. Link should 
-simply be stripped of brackets.
-
-Another [[ftp://example.com]] naked external link.
-
-And another one [[https://example.com]].
+* level 1
+** level 2
+*** level 3
+* level 1 again
 
-A really naked one here: http://example.com. Nothing should happen to it.
+# first
+## nested
+#* bullet in ordered
+# second
 """
         self.target_wikitext = \
 """
-A paragraph with a http://example.com naked external link. Link should 
-simply be stripped of brackets.
+* level 1
+  * level 2
+    * level 3
+* level 1 again
 
-Another ftp://example.com naked external link.
-
-And another one https://example.com.
+1. first
+   1. nested
+   * bullet in ordered
+1. second
+"""
+        self.convert()
 
-A really naked one here: http://example.com. Nothing should happen to it.
+    def test_lists_missing_parents(self):
+        self.source_wikitext = \
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+*** deep first item
+*** sibling
+* level 1
+## ordered, not under the bullet
+"""
+        self.target_wikitext = \
+"""
+* deep first item
+* sibling
+* level 1
+1. ordered, not under the bullet
+"""
+        self.convert()
 
-    def test_file_links(self):
+    def test_external_links(self):
         self.source_wikitext = \
 """
-A paragraph with [[file:somefile.doc]].
+A paragraph with [[http://example.com|an external link]].
 
-Another paragraph with [[file:somefile.tex|a tex file]].
+Another paragraph with [[ftp://example.com|an external link]].
+
+A [[http://example.com]] naked external link.
 """
         self.target_wikitext = \
 """
-A paragraph with [http://localhost/files/somefile.doc somefile.doc].
+A paragraph with [an external link](http://example.com).
+
+Another paragraph with [an external link](ftp://example.com).
 
-Another paragraph with [http://localhost/files/somefile.tex a tex file].
+A [http://example.com](http://example.com) naked external link.
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_file_links_withmedia(self):
+    def test_file_links(self):
         self.source_wikitext = \
 """
 A paragraph with [[file:somefile.doc]].
@@ -301,272 +270,650 @@ Another paragraph with [[file:somefile.tex|a tex file]].
 """
         self.target_wikitext = \
 """
-A paragraph with [[Media:somefile.doc]].
+A paragraph with [somefile.doc](http://localhost/files/somefile.doc).
 
-Another paragraph with [[Media:somefile.tex|a tex file]].
+Another paragraph with [a tex file](http://localhost/files/somefile.tex).
 """
-        self.converter.content = self.source_wikitext
-        self.converter.options.usemedia = True
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_code_tags(self):
+    def test_page_links(self):
         self.source_wikitext = \
 """
-A paragraph with [[code]]some code in it[[code]].
-
-[[code]]
-Some
-multiline
-code
-[[code]]
-
-Yet another paragraph with [[code]]some
-multiline
-code
-[[code]]
+A [[Page]] and [[Other Page|some text]].
 """
         self.target_wikitext = \
 """
-A paragraph with <pre>some code in it</pre>.
-
-<pre>
-Some
-multiline
-code
-</pre>
-
-Yet another paragraph with <pre>some
-multiline
-code
-</pre>
+A [Page](Page) and [some text](Other Page).
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_code_tags_verbatim(self):
+    def test_code_verbatim(self):
         self.source_wikitext = \
 """
-A paragraph with [[code]]some code **in it**[[code]].
-
-[[code]]
-Some
-multiline [[http://somestuff.com|morestuff]]
-code
-[[code]]
-
-Yet another paragraph with [[code]]some
-//multiline//
-code
+[[code format="Python"]]
+Some **bold** [[http://somestuff.com|morestuff]] //italics//
 [[code]]
 """
         self.target_wikitext = \
 """
-A paragraph with <pre>some code **in it**</pre>.
+```python
+
+Some **bold** [[http://somestuff.com|morestuff]] //italics//
 
-<pre>
-Some
-multiline [[http://somestuff.com|morestuff]]
-code
-</pre>
+```
 
-Yet another paragraph with <pre>some
-//multiline//
-code
-</pre>
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_math_tags(self):
+    def test_math(self):
         self.source_wikitext = \
 """
 A paragraph with [[math]]some math in it[[math]].
-
-[[math]]
-Some
-multiline
-math
-[[math]]
-
-Yet another paragraph with [[math]]some
-multiline
-math
-[[math]]
 """
         self.target_wikitext = \
 """
 A paragraph with <math>some math in it</math>.
-
-<math>
-Some
-multiline
-math
-</math>
-
-Yet another paragraph with <math>some
-multiline
-math
-</math>
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_image_tags(self):
+    def test_escapes(self):
         self.source_wikitext = \
 """
-A paragraph with an image:
-[[image:somefile.gif width="20" height="80" align="left" link="http://example.com" caption="some caption"]].
-
-A paragraph with a simpler image: [[image:somefile.gif]]
-
-A paragraph with a medium-complexity image: [[image:somefile.gif height="80" align="right"]]
-
-An image that should become a thumb:
-[[image:somefile.gif width="20" height="80" align="left" caption="some caption"]]
+A paragraph with some ``escaped stuff that would **otherwise be** //parsed//``.
 """
         self.target_wikitext = \
 """
-A paragraph with an image:
-[[File:somefile.gif|20x80px|left|link=http://example.com|some caption]].
-
-A paragraph with a simpler image: [[File:somefile.gif]]
-
-A paragraph with a medium-complexity image: [[File:somefile.gif|x80px|right]]
-
-An image that should become a thumb:
-[[File:somefile.gif|thumb|20x80px|left|some caption]]
+A paragraph with some `escaped stuff that would **otherwise be** //parsed//`.
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
 
-    def test_indents(self):
+    def test_images(self):
         self.source_wikitext = \
 """
-A paragraph with some <stuff>
-
-> an indented paragraph
-
->> an even more indented paragraph with some > stuff.
+A paragraph with a simple image: [[image:somefile.gif]]
 """
         self.target_wikitext = \
 """
-A paragraph with some <stuff>
-
-: an indented paragraph
-
-:: an even more indented paragraph with some > stuff.
+A paragraph with a simple image: ![somefile.gif](somefile.gif)
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
-        
-    def test_tables_simple(self):
+        self.convert()
+
+    def test_tables(self):
         self.source_wikitext = \
 """
 A paragraph...
 
-|| A simple || table ||
-|| with two || rows ||
+||~ heading1 ||= heading2 ||> heading3 ||
+|| left || center || right ||
 
-|| a table || with a
-
-multiline cell ||
-|| and another
-multiline cell || and a cell ||
+End.
 """
         self.target_wikitext = \
 """
 A paragraph...
 
-{| style="border: 1px solid #c6c9ff; border-collapse: collapse;" cellspacing="0" cellpadding="10" border="1"
-|-
-| A simple 
-| table 
-|-
-| with two 
-| rows 
-|}
-
-{| style="border: 1px solid #c6c9ff; border-collapse: collapse;" cellspacing="0" cellpadding="10" border="1"
-|-
-| a table 
-| with a
-
-multiline cell 
-|-
-| and another
-multiline cell 
-| and a cell 
-|}
+| heading1 | heading2 | heading3 |
+|----|:----:|----:|
+| left | center | right |
+
+
+End.
 """
+        self.convert()
+
+    def test_tables_large(self):
+        rows = ''.join('|| %d || cell ||\n' % i for i in range(5000))
+        self.source_wikitext = '\n||~ n ||> text ||\n' + rows + '\nEnd.\n'
+        self.target_wikitext = '\n| n | text |\n|----|----:|\n' + \
+            ''.join('| %d | cell |\n' % i for i in range(5000)) + '\n\nEnd.\n'
+        self.convert()
+
+    def test_table_rows_streamed(self):
+        table = '||= a || b ||\n|| c ||||\n|| d'
+        rows = self.converter._table_rows(table + '||', 0, len(table) + 2)
+        self.assertEqual(next(rows), [('=', ' a '), ('', ' b ')])
+        self.assertEqual(list(rows), [[('', ' c ')], [('', ' d')]])
+
+class TestHtmlConverter(unittest.TestCase):
+    def setUp(self):
+        filepath = "./test.tmp"
+        open(filepath, 'w').write('junk')
+        self.converter = wstomdconverter.WikispacesToHtmlConverter(filepath, {'format': 'html'})
+
+    def tearDown(self):
+        os.remove("./test.tmp")
+
+    def convert(self):
         self.converter.content = self.source_wikitext
         self.converter.run_regexps()
         self.assertEqual(self.converter.content, self.target_wikitext)
 
-    def test_tables_fancy(self):
+    def test_inline(self):
         self.source_wikitext = \
 """
-A paragraph...
-
-||~ heading1 ||~ heading2 ||
-||= aligned center ||> aligned right ||
-
-||~ a table ||~ with a
-
-multiline cell ||
-||> and another
-multiline cell ||= and a cell ||
+Some **bold**, //italic// and __underlined__ text with {{code}} & <tags>,
+a [[Page|link]] and ``**escaped** <stuff>``.
 """
         self.target_wikitext = \
 """
-A paragraph...
+<p>Some <strong>bold</strong>, <em>italic</em> and <u>underlined</u> text with <code>code</code> &amp; &lt;tags>,
+a <a href="Page">link</a> and **escaped** &lt;stuff&gt;.</p>
+"""
+        self.convert()
 
-{| style="border: 1px solid #c6c9ff; border-collapse: collapse;" cellspacing="0" cellpadding="10" border="1"
-|-
-! heading1 
-! heading2 
-|-
-|align="center" | aligned center 
-|align="right" | aligned right 
-|}
-
-{| style="border: 1px solid #c6c9ff; border-collapse: collapse;" cellspacing="0" cellpadding="10" border="1"
-|-
-! a table 
-! with a
-
-multiline cell 
-|-
-|align="right" | and another
-multiline cell 
-|align="center" | and a cell 
-|}
+    def test_headings_and_lists(self):
+        self.source_wikitext = \
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+= Heading 1 =
+* level 1
+** level 2
+#* mixed
+Text.
+"""
+        self.target_wikitext = \
+"""
+<h1 id="heading-1">Heading 1</h1>
+<ul><li>level 1
+<ul><li>level 2</li></ul></li></ul>
+<ol><li><ul><li>mixed</li></ul></li></ol>
+<p>Text.</p>
+"""
+        self.convert()
 
-    def test_escapes(self):
+    def test_tables(self):
         self.source_wikitext = \
 """
-A paragraph with some ``escaped stuff``.
+||~ heading1 ||= heading2 ||> heading3 ||
+|| left || center || right ||
 
-A paragraph with some ``escaped stuff that would **otherwise be parsed**``.
+End.
 """
         self.target_wikitext = \
 """
-A paragraph with some <nowiki>escaped stuff</nowiki>.
+<table>
+<tr><th>heading1</th><td style="text-align: center">heading2</td><td style="text-align: right">heading3</td></tr>
+<tr><td>left</td><td>center</td><td>right</td></tr>
+</table>
+
 
-A paragraph with some <nowiki>escaped stuff that would **otherwise be parsed**</nowiki>.
+<p>End.</p>
 """
-        self.converter.content = self.source_wikitext
-        self.converter.run_regexps()
-        self.assertEqual(self.converter.content, self.target_wikitext)
+        self.convert()
+
+    def test_images_and_code(self):
+        self.source_wikitext = \
+"""
+[[image:somefile.gif width="20" height="80" link="http://example.com" caption="some caption"]]
+[[code format="Python"]]
+if a < b:
+    pass
+[[code]]
+"""
+        self.target_wikitext = \
+"""
+<p><a href="http://example.com"><img src="somefile.gif" alt="some caption" width="20" height="80"></a></p>
+
+<pre><code class="language-python">if a &lt; b:
+    pass</code></pre>
+
+"""
+        self.convert()
+
+    def test_toc_headings_with_markup(self):
+        self.converter = wstomdconverter.WikispacesToHtmlConverter(None, {'toc': True},
+                                                                   content='= See [[Other Page|x]] & [[#t]] =\n[[toc]]\ntext\n')
+        self.assertEqual(self.converter.run(),
+                         '<h1 id="see-x-">See <a href="Other Page">x</a> &amp; <a id="t"></a></h1>\n\n'
+                         '<ul><li><a href="#see-x-">See x &amp;</a></li></ul>\n\n<p>text</p>\n')
+
+    def test_names_unescaped(self):
+        filtered = []
+        def link_filter(url, text, linktype):
+            filtered.append(url)
+            return url, text
+        self.converter = wstomdconverter.WikispacesToHtmlConverter(None, {'link_filter': link_filter, 'toc': True},
+                                                                   content='[[file:a&b.pdf]] [[image:x<y.png]] [[#a&b]]\n')
+        self.assertEqual(self.converter.run(),
+                         '<p><a href="a&amp;b.pdf">a&amp;b.pdf</a> <img src="x&lt;y.png" alt="x&lt;y.png"> <a id="a&amp;b"></a></p>\n')
+        self.assertEqual(filtered, ['x<y.png', 'a&b.pdf'])
+        self.assertEqual([asset['filename'] for asset in self.converter.assets], ['x<y.png', 'a&b.pdf'])
+
+class TestAssets(unittest.TestCase):
+    def setUp(self):
+        self.texts = ['[[image:a.png width="20" height="30"]] [[image:a.png]] [[file:b.pdf|B]]\n',
+                      '[[image:http://example.com/c.png]]\n',
+                      'No assets.\n']
+        self.filepaths = ['page1', 'page2', 'page3']
+
+    def test_page_assets(self):
+        converter = wstomdconverter.WikispacesToMarkdownConverter('page1',
+                        {'filelocation': 'files/%s'}, content=self.texts[0])
+        converter.run()
+        self.assertEqual(converter.assets,
+            [{'type': 'image', 'filename': 'a.png', 'url': 'a.png', 'width': 20, 'height': 30},
+             {'type': 'file', 'filename': 'b.pdf', 'url': 'files/b.pdf', 'width': None, 'height': None}])
+
+    def test_batch_assets(self):
+        single = []
+        for text, filepath in zip(self.texts, self.filepaths):
+            converter = wstomdconverter.WikispacesToMarkdownConverter(filepath, {}, content=text)
+            converter.run()
+            single.append(converter.assets)
+        assets = []
+        wstomdconverter.convert_batch(self.texts, {}, self.filepaths, assets)
+        self.assertEqual(assets, single)
+
+    def test_manifest_and_staging(self):
+        assets = []
+        wstomdconverter.convert_batch(self.texts, {}, self.filepaths, assets)
+        manifest = wstomdconverter.asset_manifest(list(zip(self.filepaths, assets)))
+        self.assertEqual([(asset['filename'], asset['pages']) for asset in manifest['assets']],
+                         [('a.png', ['page1']), ('b.pdf', ['page1']),
+                          ('http://example.com/c.png', ['page2'])])
+
+        import tempfile
+        source = tempfile.mkdtemp()
+        target = tempfile.mkdtemp()
+        open(os.path.join(source, 'a.png'), 'w').write('png')
+        result = wstomdconverter.stage_assets(manifest['assets'], source, target, hardlink=True)
+        self.assertEqual(result, {'staged': ['a.png'], 'unchanged': [], 'missing': ['b.pdf'],
+                                  'skipped': ['http://example.com/c.png']})
+        self.assertEqual(open(os.path.join(target, 'a.png')).read(), 'png')
+
+class TestWatchers(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.page = os.path.join(self.directory, 'page')
+        open(self.page, 'w').write('= A =')
+
+    def check(self, watcher):
+        try:
+            self.assertEqual(watcher.wait(0.1), set())
+            open(self.page, 'a').write('\n== B ==')
+            open(self.page + '_markdown', 'w').write('output')
+            os.mkdir(os.path.join(self.directory, 'sub'))
+            time.sleep(0.05)
+            open(os.path.join(self.directory, 'sub', 'other'), 'w').write('x')
+            self.assertEqual(watcher.wait(5), set([self.page, os.path.join(self.directory, 'sub', 'other')]))
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        self.check(wstomdconverter.PollingWatcher([self.directory], interval=0.02, debounce=0.1))
+
+    def test_inotify(self):
+        try:
+            watcher = wstomdconverter.InotifyWatcher([self.directory], debounce=0.1)
+        except (OSError, AttributeError, TypeError):
+            self.skipTest('no inotify')
+        self.check(watcher)
+
+    def test_inotify_directory_and_file(self):
+        import tempfile
+        other = tempfile.mkdtemp()
+        single = os.path.join(other, 'single')
+        open(single, 'w').write('x')
+        try:
+            watcher = wstomdconverter.InotifyWatcher([self.directory, single], debounce=0.1)
+        except (OSError, AttributeError, TypeError):
+            self.skipTest('no inotify')
+        try:
+            open(self.page, 'a').write('\n== B ==')
+            open(single, 'a').write('y')
+            open(os.path.join(other, 'unwatched'), 'w').write('z')
+            self.assertEqual(watcher.wait(5), set([self.page, single]))
+        finally:
+            watcher.close()
+
+class TestPasses(unittest.TestCase):
+    def setUp(self):
+        # subclasses, so that registering passes leaves the converters alone
+        self.base = type('Base', (wstomdconverter.WikispacesToMarkdownConverter,), {})
+        self.child = type('Child', (self.base,), {})
+
+    def test_registered_after_subclass_ran(self):
+        self.assertNotIn('parse_rss', [name for name, _ in self.child.pass_order()])
+        self.base.register_pass('parse_rss', lambda converter: None, after=['extract_verbatim'])
+        self.assertIn('parse_rss', [name for name, _ in self.child.pass_order()])
+        self.assertIn('parse_rss', [name for name, _ in self.child.pass_order(True)])
+
+    def test_order(self):
+        self.base.register_pass('parse_rss', lambda converter: None,
+                                after=['extract_verbatim'], before=['parse_links'])
+        names = [name for name, _ in self.base.pass_order()]
+        self.assertTrue(names.index('extract_verbatim') < names.index('parse_rss') < names.index('parse_links'))
+        self.assertEqual(names[-1], 'parse_escapes')
+        self.assertRaises(ValueError, self.base.register_pass, 'parse_rss')
+        self.assertRaises(ValueError, self.base.register_pass, 'parse_other', after=['parse_nothing'])
+        self.assertRaises(ValueError, self.base.register_pass, 'parse_cycle',
+                          after=['parse_links'], before=['parse_rss'])
+
+    def test_registered_on_base_of_html(self):
+        html = type('Html', (wstomdconverter.WikispacesToHtmlConverter, self.base), {})
+        html.register_pass('parse_own', lambda converter: None, after=['parse_bold'])
+        self.base.register_pass('parse_rss', lambda converter: None,
+                                after=['extract_verbatim'], before=['parse_links'])
+        names = [name for name, _ in html.pass_order()]
+        self.assertTrue(names.index('extract_verbatim') < names.index('parse_rss') < names.index('parse_links'))
+        self.assertTrue(names.index('escape_html') < names.index('parse_links'))
+        self.assertTrue(names.index('parse_bold') < names.index('parse_own'))
+        self.assertNotIn('parse_own', [name for name, _ in self.base.pass_order()])
+        self.assertRaises(ValueError, self.base.register_pass, 'parse_own')
+
+    def test_registered_on_markdown_runs_in_html(self):
+        converter = wstomdconverter.WikispacesToMarkdownConverter
+        def parse_feed(converter):
+            converter.content = converter._re(r'\[\[feed url="(.*?)"\]\]').sub(converter._lit(r'\1'), converter.content)
+        converter.register_pass('parse_feed', parse_feed, trigger=['[[feed'],
+                                after=['extract_verbatim'], before=['parse_links'])
+        try:
+            options = {'format': 'html'}
+            self.assertEqual(wstomdconverter.WikispacesToHtmlConverter('p', options, content='[[feed url="u"]]\n').run(),
+                             '<p>u</p>\n')
+            self.assertEqual(wstomdconverter.convert_batch(['[[feed url="u"]]\n', 'b\n'], options),
+                             ['<p>u</p>\n', '<p>b</p>\n'])
+            profile = wstomdconverter.ConversionProfile({'format': 'html', 'disabled_passes': ['parse_feed']})
+            self.assertNotIn('parse_feed', [name for name, _ in profile.pass_order(wstomdconverter.WikispacesToHtmlConverter)])
+        finally:
+            del converter._registered_passes
+
+    def test_trigger(self):
+        calls = []
+        def parse_rss(converter):
+            calls.append(converter.page_filepath)
+            converter.content = converter._re(r'\[\[rss url="(.*?)"\]\]').sub(converter._lit(r'<\1>'), converter.content)
+        self.base.register_pass('parse_rss', parse_rss, trigger=['[[rss'],
+                                after=['extract_verbatim'], before=['parse_links'])
+        self.assertEqual(self.base('no', {}, content='No feeds.\n').run(), 'No feeds.\n')
+        self.assertEqual(self.base('yes', {}, content='[[rss url="u"]]\n').run(), '<u>\n')
+        self.assertEqual(self.base('bytes', {}, content=b'[[rss url="u"]]\n').run(), b'<u>\n')
+        self.assertEqual(calls, ['yes', 'bytes'])
+
+class TestLog(unittest.TestCase):
+    def test_events_and_metrics(self):
+        import io
+        import json
+        stream = io.StringIO()
+        log = wstomdconverter.ConversionLog(stream)
+        wstomdconverter.WikispacesToMarkdownConverter('page', {'log': log},
+                        content='|| a || b ||\n|| c ||\n[[unresolved\n').run()
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(event['event'], event.get('kind')) for event in events],
+                         [('warning', 'unresolved_link'), ('warning', 'table_columns'), ('page', None)])
+        self.assertEqual((events[-1]['page'], events[-1]['warnings'], events[-1]['bytes_in']), ('page', 2, 34))
+        metrics = log.metrics()
+        self.assertIn('# TYPE wstomd_pages_total counter\nwstomd_pages_total 1\n', metrics)
+        self.assertIn('wstomd_bytes_in_total 34\n', metrics)
+        self.assertIn('wstomd_warnings_total{kind="table_columns"} 1\n', metrics)
+
+    def test_warning_text_restored(self):
+        for content in ('See [[ ``a**b`` here\n', b'See [[ ``a**b`` here\n'):
+            converter = wstomdconverter.WikispacesToMarkdownConverter('page', {}, content=content)
+            converter.run()
+            self.assertEqual(converter.warnings, [('unresolved_link', {'text': '[[ ``a**b`` he'})])
+
+    def test_batch(self):
+        log = wstomdconverter.ConversionLog()
+        wstomdconverter.convert_batch(['ok\n', '|| a || b ||\n|| c ||\n'], {'log': log}, ['p1', 'p2'])
+        self.assertEqual((log.pages, log.warnings), (2, {'table_columns': 1}))
+        self.assertTrue(log.seconds > 0)
+
+    def test_metrics_file(self):
+        import tempfile
+        metrics_path = os.path.join(tempfile.mkdtemp(), 'metrics.prom')
+        log = wstomdconverter.ConversionLog(metrics_path=metrics_path)
+        log.page('page', 10, 20, 0.5)
+        log.close()
+        metrics = open(metrics_path).read()
+        self.assertIn('wstomd_pages_total 1\n', metrics)
+        self.assertIn('wstomd_conversion_seconds_total 0.5\n', metrics)
+        self.assertIn('wstomd_bytes_out_total 20\n', metrics)
+        self.assertFalse(os.path.exists(metrics_path + '.tmp'))
+
+class TestAnalyzer(unittest.TestCase):
+    def test_features(self):
+        analyzer = wstomdconverter.WikispacesAnalyzer()
+        page = analyzer.analyze('[[code]]\n= not a heading =\n[[code]]\n* item\n** item\n'
+                                '[[image:a.png link="http://x"]] [[file:b.pdf]] [[http://x]] [[Page]] [[toc]]\n', 'p')
+        self.assertEqual(dict((feature, count) for feature, count in page['features'].items() if count),
+                         {'code': 1, 'list_items': 2, 'images': 1, 'images_with_links': 1, 'file_links': 1,
+                          'external_links': 1, 'page_links': 1, 'toc': 1})
+        analyzer.analyze('[[include page="x"]] {$page}\r\n')
+        report = analyzer.report()
+        self.assertEqual((report['pages'], report['totals']['variables'], report['totals']['lines']), (2, 1, 7))
+        self.assertEqual(report['unsupported'], {'include': 1})
+
+class TestStarter(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.page = os.path.join(self.directory, 'page')
+        open(self.page, 'w').write('= A =\n|| a ||\n[[include page="other"]] [[rss url="u"]]\n')
+
+    def starter(self, *args):
+        import sys
+        argv = sys.argv
+        sys.argv = ['wstomdconverter.py'] + list(args)
+        try:
+            return wstomdconverter.Starter()
+        finally:
+            sys.argv = argv
+
+    def test_analyze(self):
+        import io
+        import json
+        output = io.StringIO()
+        self.starter('--analyze', self.page).run_analyzer(output)
+        page, totals = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual((page['page'], page['lines']), (self.page, 3))
+        self.assertEqual([feature for feature, count in sorted(page['features'].items()) if count],
+                         ['headings', 'includes', 'tables', 'unsupported'])
+        self.assertEqual(page['unsupported'], ['include', 'rss'])
+        self.assertEqual((totals['pages'], totals['unsupported']), (1, {'include': 1, 'rss': 1}))
+
+    def test_analyze_errors(self):
+        import io
+        import json
+        bad = os.path.join(self.directory, 'bad')
+        open(bad, 'wb').write(b'\xff\xfe')
+        missing = os.path.join(self.directory, 'missing')
+        output = io.StringIO()
+        self.starter('--analyze', bad, missing, self.page).run_analyzer(output)
+        bad_page, missing_page, page, totals = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual((bad_page['page'], missing_page['page'], page['page']), (bad, missing, self.page))
+        self.assertIn('decode', bad_page['error'])
+        self.assertIn('No such file', missing_page['error'])
+        self.assertEqual((totals['pages'], totals['errors']), (1, 2))
+
+    def test_worker(self):
+        import io
+        bad = os.path.join(self.directory, 'bad')
+        open(bad, 'wb').write(b'\xff\xfe')
+        output = io.StringIO()
+        self.starter('--worker').run_worker(io.StringIO('\n'.join([self.page, bad, 'missing']) + '\n'), output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], self.page + '_markdown')
+        self.assertTrue(lines[1].startswith('error: ' + bad + ': '))
+        self.assertEqual(lines[2], 'error: no such file: missing')
+        self.assertTrue(open(self.page + '_markdown').read().startswith('# A\n| a |\n'))
+
+    def test_worker_length_prefixed(self):
+        import io
+        output = io.BytesIO()
+        self.starter('--worker', '--length-prefixed').run_worker(
+                io.BytesIO(b'6\n//a//\nx\n2\n\xff\xfe6\n= b =\n'), output)
+        self.assertEqual(output.getvalue().split(b'\n'),
+                         [b'4', b'*a*', b"error: malformed frame header b'x'",
+                          b"error: 'utf-8' codec can't decode byte 0xff in position 0: invalid start byte",
+                          b'4', b'# b', b''])
+
+    def test_worker_truncated_frame(self):
+        import io
+        output = io.BytesIO()
+        self.starter('--worker', '--length-prefixed').run_worker(io.BytesIO(b'6\n//a//\n5\nab'), output)
+        self.assertEqual(output.getvalue().split(b'\n'), [b'4', b'*a*', b'error: truncated frame', b''])
+
+class TestProfile(unittest.TestCase):
+    def test_immutable(self):
+        profile = wstomdconverter.ConversionProfile({'debug': 0, 'toc': 'yes'})
+        self.assertEqual((profile['debug'], profile['toc'], profile['format']), (False, True, 'markdown'))
+        with self.assertRaises(AttributeError):
+            profile.link_filter = None
+        with self.assertRaises(TypeError):
+            profile['toc'] = False
+        self.assertEqual(profile.replace(toc=False)['toc'], False)
+        self.assertIs(wstomdconverter.ConversionProfile.of(profile), profile)
+
+    def test_invalid(self):
+        Profile = wstomdconverter.ConversionProfile
+        self.assertRaises(ValueError, Profile, {'format': 'pdf'})
+        self.assertRaises(ValueError, Profile, {'link_filter': 42})
+        self.assertRaises(ValueError, Profile, {'disabled_passes': ['parse_nothing']})
+
+    def test_locations(self):
+        profile = wstomdconverter.ConversionProfile({'filelocation': 'http://localhost/files',
+                                                     'imagelocation': '/img/%s?size=%s',
+                                                     'link_filter': lambda url, text, linktype: url.upper()})
+        self.assertEqual(profile.file_url('a.pdf'), 'http://localhost/files/a.pdf')
+        self.assertEqual(profile.image_url('b.png'), '/img/b.png?size=b.png')
+        self.assertEqual(profile.link_filter('x', 'y', 'file'), ('X', 'X'))
+
+    def test_disabled_passes(self):
+        options = {'disabled_passes': 'parse_italics, parse_underline'}
+        text = '\n//italics// and __underline__ and **bold**\n'
+        self.assertEqual(wstomdconverter.WikispacesToMarkdownConverter(None, options, content=text).run(),
+                         '\n//italics// and __underline__ and **bold**\n')
+        self.assertEqual(wstomdconverter.convert_batch([text, text], options),
+                         ['\n//italics// and __underline__ and **bold**\n'] * 2)
+
+    def test_load_and_pickle(self):
+        import pickle
+        import tempfile
+        directory = tempfile.mkdtemp()
+        ini = os.path.join(directory, 'profile.ini')
+        open(ini, 'w').write('[wstomdconverter]\nfilelocation = files/\ntoc = yes\n'
+                             'link_filter = posixpath:join\ndisabled_passes = parse_math\n')
+        profile = wstomdconverter.ConversionProfile.load(ini, format='html')
+        self.assertEqual((profile['toc'], profile['format'], profile.file_url('a')), (True, 'html', 'files/a'))
+        self.assertEqual(profile.link_filter('a', 'b', 'page'), ('a/b/page', 'a/b/page'))
+        self.assertEqual(dict(pickle.loads(pickle.dumps(profile))), dict(profile))
+        order = profile.pass_order(wstomdconverter.WikispacesToHtmlConverter)
+        self.assertNotIn('parse_math', [name for name, _ in order])
+        self.assertEqual(pickle.loads(pickle.dumps(profile)).pass_order(wstomdconverter.WikispacesToHtmlConverter), order)
+
+        json_file = os.path.join(directory, 'profile.json')
+        open(json_file, 'w').write('{"imagelocation": "img/%s", "debug": true}')
+        profile = wstomdconverter.ConversionProfile.load(json_file)
+        self.assertEqual((profile['debug'], profile.image_url('a')), (True, 'img/a'))
+        open(json_file, 'w').write('{"jobs": 4}')
+        self.assertRaises(ValueError, wstomdconverter.ConversionProfile.load, json_file)
+        open(json_file, 'w').write('{"toc": "no", "debug": "On"}')
+        profile = wstomdconverter.ConversionProfile.load(json_file)
+        self.assertEqual((profile['toc'], profile['debug']), (False, True))
+        open(json_file, 'w').write('{"toc": "maybe"}')
+        self.assertRaises(ValueError, wstomdconverter.ConversionProfile.load, json_file)
+
+class TestEngines(unittest.TestCase):
+    '''The other engines have to give the same output as the reference.'''
+    def setUp(self):
+        rng = random.Random(1)
+        self.texts = wstomddiff.synthetic_pages(50, rng)
+        self.texts += wstomddiff.fuzz_pages(self.texts, 50, rng)
+        self.filepaths = ['page{}'.format(i) for i in range(len(self.texts))]
+
+    def assertSame(self, candidate):
+        results = wstomddiff.compare(self.texts, self.filepaths, candidate)
+        self.assertEqual([result['filepath'] for result in results if not result['same']], [])
+
+    def test_bytes(self):
+        self.assertSame('bytes')
+
+    def test_batch(self):
+        self.assertSame('batch')
+
+    def test_parallel(self):
+        self.assertSame('parallel')
+
+    def test_bytes_literals_bounded(self):
+        page = '[[code]]x[[code]] ``e`` [[math]]m[[math]]\n'
+        wstomdconverter.WikispacesToMarkdownConverter(None, {'binary': True}, content=page).run()
+        cached = len(wstomdconverter._literals)
+        for _ in range(20):
+            wstomdconverter.WikispacesToMarkdownConverter(None, {'binary': True}, content=page).run()
+        self.assertEqual(len(wstomdconverter._literals), cached)
+
+    def test_parallel_bytes(self):
+        texts = [text.encode('utf-8') if i % 2 else text for i, text in enumerate(self.texts[:20])]
+        self.assertEqual(wstomdconverter.convert_parallel(texts, {'binary': True}, processes=2),
+                         wstomdconverter.convert_batch(texts, {'binary': True}))
+
+    def test_parallel_warnings(self):
+        texts = ['|| a || b ||\n|| c ||\n', 'ok [[broken\n', 'x\n'] + self.texts[:20]
+        batch, parallel = [], []
+        wstomdconverter.convert_batch(texts, warnings=batch)
+        wstomdconverter.convert_parallel(texts, processes=2, chunksize=2, warnings=parallel)
+        self.assertEqual(parallel, batch)
+        self.assertEqual(batch[:3], [[('table_columns', {'row': 1, 'cells': 1, 'columns': 2})],
+                                     [('unresolved_link', {'text': '[[broken'})], []])
+
+    def test_html_batch(self):
+        results = wstomddiff.compare(self.texts, self.filepaths, 'batch', {'format': 'html'})
+        self.assertEqual([result['filepath'] for result in results if not result['same']], [])
+
+    def test_corpus_without_outputs(self):
+        import tempfile
+        directory = tempfile.mkdtemp()
+        for filename in ('page', 'page_markdown', 'page_html', 'page~', '.hidden'):
+            open(os.path.join(directory, filename), 'w').write(filename)
+        self.assertEqual(wstomddiff.read_corpus([directory]), [(os.path.join(directory, 'page'), 'page')])
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        import threading
+        self.server = wstomdservice.ConversionServer(('127.0.0.1', 0), {'filelocation': 'files/'})
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, method, path, body=None):
+        import http.client
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        result = (response.status, response.read().decode('utf-8'))
+        connection.close()
+        return result
+
+    def test_convert(self):
+        page = '= A =\n[[file:b.pdf]] //c//\n'
+        self.assertEqual(self.request('POST', '/convert', page.encode('utf-8')),
+                         (200, wstomdconverter.WikispacesToMarkdownConverter(
+                                None, {'filelocation': 'files/'}, content=page).run()))
+        self.assertEqual(self.request('POST', '/convert?format=html', page.encode('utf-8'))[1],
+                         wstomdconverter.WikispacesToHtmlConverter(
+                                None, {'filelocation': 'files/'}, content=page).run())
+        self.assertEqual(self.request('POST', '/convert?format=pdf', b'')[0], 400)
+        self.assertIn('wstomd_pages_total 2\n', self.request('GET', '/metrics')[1])
+
+    def test_profiles_bounded(self):
+        for value in ('a', 'b', 'c', 'no', '1', 'yes'):
+            self.server.profile_for('toc=' + value)
+        self.assertEqual(len(self.server.profiles), 3)
+
+    def test_load(self):
+        pages = wstomddiff.synthetic_pages(20, random.Random(2))
+        result = wstomdservice.run_load(self.url, pages, concurrency=3, requests=30,
+                                        pid=os.getpid(), interval=0.01)
+        summary = wstomdservice.summarize(result)
+        self.assertEqual((summary['requests'], summary['errors']), (30, 0))
+        self.assertTrue(summary['latency']['p50'] <= summary['latency']['p99'] <= summary['latency']['max'])
+        self.assertEqual(sum(bucket['requests'] for bucket in summary['by_size']), 30)
+        self.assertEqual(wstomdservice.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(wstomdservice.percentile([1, 2, 3, 4], 99), 4)
 
 if __name__ == '__main__':
     unittest.main()
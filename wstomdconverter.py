@@ -14,9 +14,13 @@
 
 
 import re
-import optparse
 import os.path
-import random
+import sys
+import threading
+import time
+
+# Joins the pages of a batch; none of the conversion patterns match across it.
+PAGE_SEPARATOR = '\x00'
 
 class VersionInfo:
     '''Just a container for some information.'''
@@ -26,39 +30,654 @@ class VersionInfo:
     url = 'https://github.com/speters/wikispacestomarkdown/'
     # author='Daniel Folkinshteyn'
 
+class Patterns:
+    '''Just a container for the regexps shared by the conversion passes and
+    the analyzer.
+
+    Patterns that can span lines exclude PAGE_SEPARATOR, see
+    WikispacesBatchConverter.
+    '''
+    toc = r'\n?\[\[toc(\|flat)?\]\]'
+    anchor = r'( *)\[\[#(.*?)\]\]( *)'
+    # the newline after a heading is not consumed, it starts the next line
+    heading = r'\n *(=+)[ \t]*(.*?)[ \t]*=+([ \t]*)(?=\n)'
+    italics = r'(?<!http:)(?<!https:)(?<!ftp:)//'
+    external_link_text = r'\[\[@?(https?://[^|\]\x00]*)\|([^\]\x00]*)\]\]'
+    ftp_link_text = r'\[\[@?(ftp://[^|\]\x00]*)\|([^\]\x00]*)\]\]'
+    external_link = r'\[\[@?(https?://[^|\]\x00]*)\]\]'
+    ftp_link = r'\[\[@?(ftp://[^|\]\x00]*)\]\]'
+    file_link_text = r'\[\[file:([^|\]\x00]*)\|([^\]\x00]*)\]\]'
+    file_link = r'\[\[file:([^|\]\x00]*)\]\]'
+    page_link_text = r'\[\[([^|\]\x00]*)\|([^\]\x00]*)\]\]'
+    page_link = r'\[\[([^|\]\x00]*)\]\]'
+    underline = r'__([^\x00]*?)__'
+    monospaced = r'{{([^\x00]*?)}}'
+    include = r'\[\[include page="([^"\x00]*?)"[^\]\x00]*?\]\]'
+    code = r'\[\[code( +format="[^\x00]*?")?\]\]([^\x00]*?)\[\[code\]\]'
+    math = r'\[\[math( +format="[^\x00]*?")?\]\]([^\x00]*?)\[\[math\]\]'
+    escape = r'``(.*)``'
+    image = r'\[\[image:[^\]\x00]+\]\]'
+    table = r'(?<=\n)([|][|][^\x00]*?[|][|])(?=\n[^|]|\n[|][^|])'
+    # any [[...]] tag, used by the analyzer to sort out what a page links to
+    tag = r'\[\[([^\]\x00]*)\]\]'
+    # a [[name attribute="value" ...]] tag, like [[media ...]] or [[rss ...]]
+    widget = r'(\w+)(?: +[\w-]+="[^"\x00]*")+ *'
+
+# compiled patterns, by pattern and by whether they are for bytes content
+_compiled = {}
+# utf-8 encoded literals, see WikispacesToMarkdownConverter._lit()
+_literals = {}
+
+def _compile(pattern, binary=False):
+    '''Compile pattern, for bytes content if binary is set.
+
+    All patterns are ASCII, so they work on utf-8 encoded content just the
+    same; their \\s, \\w and \\d then only match ASCII characters.
+    '''
+    try:
+        return _compiled[pattern, binary]
+    except KeyError:
+        compiled = re.compile(pattern.encode('ascii') if binary else pattern)
+        _compiled[pattern, binary] = compiled
+        return compiled
+
+def _size(content):
+    '''Size of content (str or bytes) in bytes, utf-8 encoded.'''
+    return len(content) if isinstance(content, bytes) else len(content.encode('utf-8'))
+
+def _batch_shares(seconds, sizes):
+    '''The time of a batch, split over its pages by size.'''
+    total = float(sum(size + 1 for size in sizes))
+    return [seconds * (size + 1) / total for size in sizes]
+
+class ConversionLog:
+    '''Collects events and metrics of a conversion run.
+
+    Events (pages, warnings, debug output) are written as JSON lines to
+    stream, if one is given. Counters are kept in any case and, if
+    metrics_path is given, written there in the Prometheus text format at
+    most every interval seconds and by close().
+
+    Pass an instance as options['log'] to the converters. A log may be
+    shared by converters in several threads.
+    '''
+    def __init__(self, stream=None, metrics_path=None, interval=10.0):
+        self.lock = threading.RLock()
+        self.stream = stream
+        self.metrics_path = metrics_path
+        self.interval = interval
+        self.started = time.time()
+        self.metrics_written = self.started
+        self.pages = 0
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.warnings = {}
+
+    def event(self, event, **fields):
+        if self.stream is None:
+            return
+        import json
+        fields['event'] = event
+        fields['time'] = round(time.time(), 6)
+        line = json.dumps(fields, sort_keys=True) + '\n'
+        with self.lock:
+            self.stream.write(line)
+
+    def rate(self):
+        '''Pages converted per second since the log was created.'''
+        elapsed = time.time() - self.started
+        return self.pages / elapsed if elapsed > 0 else 0.0
+
+    def page(self, page, bytes_in, bytes_out, seconds=None, warnings=0):
+        '''Account for a converted page.
+
+        For the pages of a batch, seconds is their share of the time of the
+        batch, by size; see _batch_shares().
+        '''
+        with self.lock:
+            self.pages += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            if seconds is not None:
+                self.seconds += seconds
+            self.event('page', page=page, bytes_in=bytes_in, bytes_out=bytes_out,
+                       seconds=seconds, warnings=warnings, rate=round(self.rate(), 3))
+            if self.metrics_path is not None and time.time() - self.metrics_written >= self.interval:
+                self.write_metrics()
+
+    def batch(self, pages, seconds):
+        '''Record a batch of pages converted at once; its time is accounted
+        for by the page() calls of its pages.'''
+        self.event('batch', pages=pages, seconds=seconds)
+
+    def warning(self, page, kind, **fields):
+        with self.lock:
+            self.warnings[kind] = self.warnings.get(kind, 0) + 1
+            self.event('warning', page=page, kind=kind, **fields)
+
+    def debug(self, page, message):
+        self.event('debug', page=page, message=message)
+
+    def metrics(self):
+        '''The counters in the Prometheus text exposition format.'''
+        with self.lock:
+            return self._metrics()
+
+    def _metrics(self):
+        lines = []
+        def metric(name, kind, helptext, samples):
+            lines.append('# HELP {} {}'.format(name, helptext))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, labels, value))
+        metric('wstomd_pages_total', 'counter', 'Pages converted.', [('', self.pages)])
+        metric('wstomd_conversion_seconds_total', 'counter', 'Time spent converting pages.', [('', round(self.seconds, 6))])
+        metric('wstomd_bytes_in_total', 'counter', 'Size of the source pages.', [('', self.bytes_in)])
+        metric('wstomd_bytes_out_total', 'counter', 'Size of the converted pages.', [('', self.bytes_out)])
+        metric('wstomd_warnings_total', 'counter', 'Conversion warnings by kind.',
+               [('{{kind="{}"}}'.format(kind), count) for kind, count in sorted(self.warnings.items())])
+        metric('wstomd_pages_per_second', 'gauge', 'Pages converted per second since start.', [('', round(self.rate(), 3))])
+        return '\n'.join(lines) + '\n'
+
+    def write_metrics(self):
+        # write and rename, so that a collector never reads a partial file
+        with self.lock:
+            tmp_path = self.metrics_path + '.tmp'
+            open(tmp_path, 'w').write(self.metrics())
+            os.replace(tmp_path, self.metrics_path)
+            self.metrics_written = time.time()
+
+    def close(self):
+        if self.metrics_path is not None:
+            self.write_metrics()
+        if self.stream is not None:
+            self.stream.flush()
+
+class ConversionProfile:
+    '''The options of a conversion, checked and prepared once.
+
+    Converters take a plain dict of options and turn it into a profile;
+    make one yourself to share it between many converters, e.g. all pages
+    of a run. A profile reads like the dict it was made from, with the
+    values normalized, and can not be changed: replace() makes a changed
+    copy. The conversion options are:
+
+        debug            print debug output
+        filelocation     URL of [[file:...]] links, with %s for the file
+                         name; without %s, the file name is appended
+        imagelocation    the same for [[image:...]]
+        link_filter      function(url, text, linktype) returning (url,
+                         text) or just url, or the 'module:function' name
+                         of one
+        format           'markdown' or 'html'
+        toc              generate tables of contents, see parse_toc()
+        binary           convert as utf-8 encoded bytes
+        disabled_passes  names of conversion passes not to run
+        log              a ConversionLog
+
+    Other keys, like the command line options, are kept as they are.
+    A profile pickles as the options it was made from, so sending one to a
+    worker process costs no more than the dict; the link filter has to be
+    picklable (a module level function, or its name) then.
+    '''
+    flags = ('debug', 'binary', 'toc')
+    settings = ('filelocation', 'imagelocation', 'link_filter', 'format', 'disabled_passes')
+
+    def __init__(self, options=None, **changes):
+        source = dict(options or {})
+        source.update(changes)
+        values = dict(source)
+        for flag in self.flags:
+            value = values.get(flag)
+            if isinstance(value, str):
+                # as in INI files, so that "no" from JSON is not true
+                import configparser
+                states = configparser.ConfigParser.BOOLEAN_STATES
+                if value.lower() not in states:
+                    raise ValueError("{} has to be a boolean, not {!r}".format(flag, value))
+                value = states[value.lower()]
+            values[flag] = bool(value)
+
+        values['format'] = values.get('format') or 'markdown'
+        if values['format'] not in FORMATS:
+            raise ValueError("unknown format '{}', not one of [{}]".format(values['format'], ', '.join(sorted(FORMATS))))
+
+        templates = {}
+        for key in ('filelocation', 'imagelocation'):
+            location = values.get(key) or '%s'
+            if not isinstance(location, str):
+                raise ValueError("{} has to be a string, not {!r}".format(key, location))
+            if '%s' not in location:
+                location += ('' if location.endswith('/') else '/') + '%s'
+            values[key] = location
+            templates[key] = location.split('%s')
+
+        link_filter = values.get('link_filter')
+        if isinstance(link_filter, str):
+            link_filter = self._function(link_filter)
+        if link_filter is not None and not callable(link_filter):
+            raise ValueError("link_filter has to be callable, not {!r}".format(link_filter))
+
+        disabled = values.get('disabled_passes') or ()
+        if isinstance(disabled, str):
+            disabled = [name.strip() for name in disabled.split(',') if name.strip()]
+        passes = set(name for name, _ in FORMATS[values['format']][0].pass_order())
+        unknown = set(disabled) - passes
+        if unknown:
+            raise ValueError("unknown passes: {}".format(', '.join(sorted(unknown))))
+        values['disabled_passes'] = frozenset(disabled)
+
+        # the profile can not be changed, see __setattr__()
+        init = lambda name, value: object.__setattr__(self, name, value)
+        init('_source', source)
+        init('_values', values)
+        init('_templates', templates)
+        init('_pass_orders', {})
+        init('link_filter', self._wrap_link_filter(link_filter))
+
+    @classmethod
+    def of(cls, options):
+        '''options as a profile: itself, if it is one already.'''
+        if isinstance(options, cls):
+            return options
+        return cls(options)
+
+    @classmethod
+    def load(cls, filepath, **changes):
+        '''A profile from a config file, see read().'''
+        return cls(cls.read(filepath), **changes)
+
+    @classmethod
+    def read(cls, filepath):
+        '''The options in a config file, as a dict.
+
+        *.json files hold an object with the options, other files are INI
+        files with the options in a [wstomdconverter] section:
+
+            [wstomdconverter]
+            filelocation = http://example.com/files/
+            link_filter = mymodule:link_filter
+            disabled_passes = parse_underline, parse_monospaced
+            toc = yes
+        '''
+        if filepath.endswith('.json'):
+            import json
+            with open(filepath) as infile:
+                options = json.load(infile)
+            if not isinstance(options, dict):
+                raise ValueError("{}: expected an object of options".format(filepath))
+        else:
+            import configparser
+            parser = configparser.ConfigParser(interpolation=None)
+            with open(filepath) as infile:
+                parser.read_file(infile)
+            if not parser.has_section('wstomdconverter'):
+                raise ValueError("{}: no [wstomdconverter] section".format(filepath))
+            options = {}
+            for key, value in parser.items('wstomdconverter'):
+                if key in cls.flags:
+                    value = parser.getboolean('wstomdconverter', key)
+                options[key] = value
+        unknown = set(options) - set(cls.flags + cls.settings)
+        if unknown:
+            raise ValueError("{}: unknown options: {}".format(filepath, ', '.join(sorted(unknown))))
+        return options
+
+    @staticmethod
+    def _function(name):
+        import importlib
+        modulename, _, functionname = name.partition(':')
+        if not functionname:
+            raise ValueError("'{}' is not a module:function name".format(name))
+        return getattr(importlib.import_module(modulename), functionname)
+
+    @staticmethod
+    def _wrap_link_filter(link_filter):
+        '''link_filter, always returning (url, text).'''
+        if link_filter is None:
+            return lambda url, text, linktype: (url, text)
+        def wrapped(url, text, linktype):
+            ret = link_filter(url, text, linktype)
+            try:
+                returl, rettext = ret
+            except ValueError:
+                returl = ret
+                rettext = returl
+            return returl, rettext
+        return wrapped
+
+    def file_url(self, filename):
+        return filename.join(self._templates['filelocation'])
+
+    def image_url(self, filename):
+        return filename.join(self._templates['imagelocation'])
+
+    def pass_order(self, cls, binary=False):
+        '''The (name, trigger) of the passes cls runs, without the disabled ones.'''
+        order = cls.pass_order(binary)
+        if not self._values['disabled_passes']:
+            return order
+        # recomputed when register_pass() changed the order
+        cached = self._pass_orders.get((cls, binary))
+        if cached is None or cached[0] is not order:
+            cached = (order, [(name, trigger) for name, trigger in order
+                              if name not in self._values['disabled_passes']])
+            self._pass_orders[(cls, binary)] = cached
+        return cached[1]
+
+    def replace(self, **changes):
+        '''A copy of the profile with some options changed.'''
+        return self.__class__(self._source, **changes)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("profiles can not be changed, use replace()")
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (self.__class__, (self._source,))
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._source)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return self._values.keys()
+
+    def items(self):
+        return self._values.items()
+
 class Starter:
     '''Grabs cli options, and runs the converter on specified files.'''
     def __init__(self):
         self.parse_options()
 
     def start(self):
+        log = self.options['log']
+        try:
+            self.run()
+        finally:
+            if log is not None:
+                log.close()
+
+    def run(self):
+        if self.options['worker']:
+            self.run_worker()
+            return
+        if self.options['watch']:
+            self.run_watch()
+            return
+        if self.options['analyze']:
+            self.run_analyzer()
+            return
+        assets = []
+        if self.options['jobs'] > 1:
+            texts = [open(filepath).read() for filepath in self.args]
+            results = convert_parallel(texts, self.profile, self.args,
+                                       processes=self.options['jobs'], assets=assets)
+            for filepath, result in zip(self.args, results):
+                output_filepath = converter_class(self.profile).output_filepath(filepath)
+                open(output_filepath, 'w').write(result)
+        else:
+            for filepath in self.args:
+                wp = converter_class(self.profile)(filepath, self.profile)
+                wp.run()
+                assets.append(wp.assets)
+        if self.options['manifest_file'] is not None or self.options['stage_from'] is not None:
+            self.run_assets(asset_manifest(list(zip(self.args, assets))))
+
+    def run_assets(self, manifest):
+        '''Write the asset manifest and stage the assets, as requested.'''
+        import json
+        if self.options['manifest_file'] is not None:
+            with open(self.options['manifest_file'], 'w') as outfile:
+                json.dump(manifest, outfile, indent=1, sort_keys=True)
+        if self.options['stage_from'] is None:
+            return
+        result = stage_assets(manifest['assets'], self.options['stage_from'],
+                              self.options['stage_to'], self.options['hardlink'])
+        log = self.options['log']
+        for filename in result['missing']:
+            if log is not None:
+                log.warning(None, 'missing_asset', filename=filename)
+            else:
+                print('missing asset: {}'.format(filename), file=sys.stderr)
+
+    def run_analyzer(self, outstream=None):
+        '''Print the feature counts of every file, then the corpus totals.
+
+        The output is JSON, one line per page and a last line for the totals.
+        Files that can not be read get a line with the error instead.
+        '''
+        import json
+        outstream = outstream or sys.stdout
+        analyzer = WikispacesAnalyzer()
         for filepath in self.args:
-            wp = WikispacesToMarkdownConverter(filepath, self.options)
-            wp.run()
+            try:
+                with open(filepath) as infile:
+                    content = infile.read()
+            except (OSError, UnicodeDecodeError) as e:
+                page = analyzer.error(filepath, e)
+            else:
+                page = analyzer.analyze(content, filepath)
+            outstream.write(json.dumps(page, sort_keys=True) + '\n')
+        outstream.write(json.dumps(analyzer.report(), sort_keys=True) + '\n')
+
+    def run_watch(self, outstream=None, watcher=None, rounds=None):
+        '''Convert the pages in the given files and directories whenever they
+        change, until interrupted.
+
+        Pages without an up to date output are converted right away. After
+        that, every burst of writes is converted as one batch; the output
+        filepath of every converted page is echoed. rounds limits the number
+        of bursts to wait for.
+        '''
+        outstream = outstream or sys.stdout
+        if watcher is None:
+            watcher = page_watcher(self.args, polling=self.options['poll'])
+        stale = []
+        for filepath in watched_files(self.args):
+            output_filepath = converter_class(self.profile).output_filepath(filepath)
+            if (not os.path.exists(output_filepath)
+                    or os.path.getmtime(output_filepath) < os.path.getmtime(filepath)):
+                stale.append(filepath)
+        try:
+            changed = stale
+            while True:
+                if changed:
+                    self.convert_files(sorted(changed), outstream)
+                if rounds is not None:
+                    if rounds == 0:
+                        break
+                    rounds -= 1
+                try:
+                    changed = watcher.wait()
+                except KeyboardInterrupt:
+                    break
+        finally:
+            watcher.close()
+
+    def convert_files(self, filepaths, outstream):
+        '''Convert some pages as a batch, write their outputs.'''
+        pages = []
+        for filepath in filepaths:
+            try:
+                pages.append((filepath, open(filepath, 'rb' if self.options['binary'] else 'r').read()))
+            except (OSError, UnicodeDecodeError):
+                # deleted or renamed again in the meantime
+                pass
+        filepaths = [filepath for filepath, _ in pages]
+        results = convert_batch([text for _, text in pages], self.profile, filepaths)
+        for filepath, result in zip(filepaths, results):
+            output_filepath = converter_class(self.profile).output_filepath(filepath)
+            open(output_filepath, 'wb' if isinstance(result, bytes) else 'w').write(result)
+            outstream.write(output_filepath + '\n')
+        outstream.flush()
+
+    def run_worker(self, instream=None, outstream=None):
+        '''Keep converting pages read from stdin until EOF.
+
+        By default every input line is a filepath; the page is converted like
+        a command line argument and the output filepath is echoed back, one
+        line per request. With --length-prefixed, stdin carries frames of the
+        form "<number of bytes>\\n<utf-8 page content>" and every converted
+        page is written back to stdout in the same framing.
+
+        A request which can not be converted (no such file, not utf-8, a
+        malformed frame header, a frame cut short by EOF) is answered with a line "error: <reason>",
+        in place of the output filepath or the frame.
+
+        The interpreter, option parsing and the regexp cache are paid for
+        once, instead of once per page.
+        '''
+        if self.options['length_prefixed']:
+            instream = instream or sys.stdin.buffer
+            outstream = outstream or sys.stdout.buffer
+            while True:
+                header = instream.readline()
+                if not header:
+                    break
+                try:
+                    length = int(header)
+                    if length < 0:
+                        raise ValueError
+                except ValueError:
+                    # the frame is lost; go on with the next line
+                    outstream.write(b'error: malformed frame header %r\n' % header.rstrip(b'\n')[:40])
+                    outstream.flush()
+                    continue
+                content = instream.read(length)
+                if len(content) != length:
+                    # only at EOF, there is nothing left to go on with
+                    outstream.write(b'error: truncated frame\n')
+                    outstream.flush()
+                    break
+                try:
+                    if not self.options['binary']:
+                        content = content.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    outstream.write('error: {}\n'.format(e).encode('utf-8'))
+                    outstream.flush()
+                    continue
+                result = converter_class(self.profile)(None, self.profile, content=content).run()
+                if not isinstance(result, bytes):
+                    result = result.encode('utf-8')
+                outstream.write(b'%d\n' % len(result))
+                outstream.write(result)
+                outstream.flush()
+        else:
+            instream = instream or sys.stdin
+            outstream = outstream or sys.stdout
+            for line in instream:
+                filepath = line.rstrip('\n')
+                if not filepath:
+                    continue
+                if os.path.isfile(filepath):
+                    try:
+                        wp = converter_class(self.profile)(filepath, self.profile)
+                    except UnicodeDecodeError as e:
+                        outstream.write('error: {}: {}\n'.format(filepath, e))
+                    else:
+                        outstream.write(wp.run() + '\n')
+                else:
+                    outstream.write('error: no such file: {}\n'.format(filepath))
+                outstream.flush()
 
     def parse_options(self):
         '''Read command line options
         '''
+        # optparse is by far the most expensive import of this script, so it
+        # is only loaded when we actually run from the command line.
+        import optparse
         parser = optparse.OptionParser(
                         version=VersionInfo.name + " version " +VersionInfo.version + "\nProject homepage: " + VersionInfo.url,
                         description="This script can convert a Wikispaces-style source page into a Markdown-style source page. For a more detailed usage manual, see the project homepage: " + VersionInfo.url,
                         formatter=optparse.TitledHelpFormatter(),
                         usage="%prog [options] file.creole [file2.creole...]\n")
+        parser.add_option("-c", "--config", action="store", dest="config", help="Read conversion options from this file: JSON, or INI with a [wstomdconverter] section. Besides the options below, it may set link_filter (as module:function) and disabled_passes. Command line options take precedence. [default: %default]")
         parser.add_option("-d", "--debug", action="store_true", dest="debug", help="debug mode (print some extra debug output). [default: %default]")
         parser.add_option("-f", "--file", action="append", dest="file", help="Specify filepath to convert. For multiple files use this option multiple times. [default: %default]")
         parser.add_option("-F", "--filelocation", action="store", dest="filelocation", help="Specify the full/relative URL of directory where files are hosted. This will be used to convert [[file:%s]] links to external links [default: %default]. %s can be used as a placeholder for the linked filename (useful for relative paths)")
         parser.add_option("-I", "--imagelocation", action="store", dest="imagelocation", help="Specify the full/relative URL of directory where images are hosted. This will be used to convert embedded [[image:%s]] to markdown. %s can be used as the placeholder for the image filename [default: %default]")
+        parser.add_option("-w", "--worker", action="store_true", dest="worker", help="Long-lived worker mode: read filepaths from stdin, one per line, and echo the output filepath for each converted page. [default: %default]")
+        parser.add_option("--length-prefixed", action="store_true", dest="length_prefixed", help="In worker mode, read page content instead of filepaths from stdin, framed as '<number of bytes>\\n<content>', and write the converted pages back in the same framing. [default: %default]")
+
+        parser.add_option("--watch", action="store_true", dest="watch", help="Watch the given files and directories, and convert pages whenever they change, until interrupted. Uses inotify where available. [default: %default]")
+        parser.add_option("--poll", action="store_true", dest="poll", help="In watch mode, look for changes by polling instead of inotify. [default: %default]")
+        parser.add_option("-b", "--bytes", action="store_true", dest="binary", help="Convert pages as utf-8 encoded bytes, instead of decoding them. Can lower peak memory on long, mostly ASCII pages with a few characters outside Latin-1, but is slower than converting str. [default: %default]")
+        parser.add_option("-l", "--log", action="store", dest="log_file", help="Write conversion events (per page duration and sizes, warnings, debug output) to this file as JSON lines; '-' is stderr. [default: %default]")
+        parser.add_option("-m", "--metrics", action="store", dest="metrics_file", help="Write conversion metrics to this file in the Prometheus text format, every ten seconds and at the end. [default: %default]")
+        parser.add_option("-o", "--format", action="store", dest="format", choices=['markdown', 'html'], help="Output format: markdown or html. [default: %default]")
+        parser.add_option("--toc", action="store_true", dest="toc", help="Replace [[toc]] by a generated table of contents, and keep [[#anchor]] targets as html anchors, instead of removing both. [default: %default]")
+        parser.add_option("--manifest", action="store", dest="manifest_file", help="Write the images and files the converted pages refer to (with link type and dimensions, and which pages use them) to this file as JSON. [default: %default]")
+        parser.add_option("--stage-from", action="store", dest="stage_from", help="Copy the images and files the converted pages refer to from this directory, the files directory of the Wikispaces export, to --stage-to. [default: %default]")
+        parser.add_option("--stage-to", action="store", dest="stage_to", help="Directory to stage the files referred to into. [default: %default]")
+        parser.add_option("--hardlink", action="store_true", dest="hardlink", help="Stage files as hardlinks instead of copies, where possible. [default: %default]")
+        parser.add_option("-a", "--analyze", action="store_true", dest="analyze", help="Do not convert anything, but print (as JSON) which markup features every file uses, and totals for all of them. [default: %default]")
+        parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", help="Number of worker processes converting the given files in parallel. [default: %default]")
 
         parser.set_defaults(debug=False,
                             filelocation='',
-                            imagelocation='')
+                            imagelocation='',
+                            worker=False,
+                            length_prefixed=False,
+                            watch=False,
+                            poll=False,
+                            jobs=1,
+                            analyze=False,
+                            binary=False,
+                            log_file=None,
+                            metrics_file=None,
+                            toc=False,
+                            format='markdown',
+                            manifest_file=None,
+                            stage_from=None,
+                            stage_to='.',
+                            hardlink=False)
 
         (self.options, self.args) = parser.parse_args()
+        if self.options.config is not None:
+            # the config file sets the defaults, the command line overrides them
+            try:
+                parser.set_defaults(**ConversionProfile.read(self.options.config))
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+            (self.options, self.args) = parser.parse_args()
         self.options = vars(self.options)
         if self.options['debug']:
-            print("Your commandline options:\n", self.options)
+            print("Your commandline options:\n", self.options, file=sys.stderr)
+
+        self.options['log'] = None
+        if self.options['log_file'] is not None or self.options['metrics_file'] is not None:
+            if self.options['log_file'] == '-':
+                stream = sys.stderr
+            elif self.options['log_file'] is not None:
+                stream = open(self.options['log_file'], 'a')
+            else:
+                stream = None
+            self.options['log'] = ConversionLog(stream, self.options['metrics_file'])
+
+        try:
+            self.profile = ConversionProfile(self.options)
+        except (ImportError, AttributeError, ValueError) as e:
+            parser.error(str(e))
 
-        if self.args == []: # where foo is obviously your required option
+        if self.args == [] and not self.options['worker']: # where foo is obviously your required option
             parser.print_help()
             exit(1)
 
@@ -69,149 +688,526 @@ class WikispacesToMarkdownConverter:
     http://www.markdown.org/wiki/Help:Formatting
     http://www.wikispaces.com/wikitext
     '''
-    def __init__(self, filepath, options):
+    # The built-in conversion passes: name, trigger and the names of the
+    # passes it has to run after. The trigger is a tuple of substrings, at
+    # least one of which has to occur in the content for the pass to have
+    # anything to do, or None to always run it. Passes are methods of the
+    # converter, unless register_pass() was given a function for them.
+    # Passes registered later are kept per class, in _registered_passes,
+    # and merged with these by _merge_passes().
+    passes = [
+        ('extract_verbatim', ('[[code', '``', '[[math'), ()),
+        ('remove_misc', ('[[',), ('extract_verbatim',)),
+        ('parse_lists', ('*', '#', '+'), ('extract_verbatim', 'remove_misc')),
+        ('parse_headings', ('=',), ('extract_verbatim', 'parse_lists')),
+        ('parse_toc', ('[[toc',), ('remove_misc', 'parse_headings')),
+        ('parse_italics', ('//',), ('extract_verbatim',)),
+        ('parse_images', ('[[image:',), ('extract_verbatim',)),
+        ('parse_file_links', ('[[file:',), ('extract_verbatim',)),
+        ('parse_external_links', ('[[http', '[[ftp', '[[@'), ('extract_verbatim',)),
+        ('parse_underline', ('__',), ('extract_verbatim',)),
+        ('parse_monospaced', ('{{',), ('extract_verbatim',)),
+        ('parse_variables', ('{$page}',), ('extract_verbatim',)),
+        # parse_includes is not registered, its output is not markdown
+        ('parse_links', ('[[',), ('remove_misc', 'parse_toc', 'parse_images', 'parse_file_links', 'parse_external_links')),
+        ('parse_tables', ('||',), ('extract_verbatim',)),
+        ('restore_verbatim', ('verbatim_placeholder_',),
+            ('remove_misc', 'parse_lists', 'parse_headings', 'parse_toc', 'parse_italics',
+             'parse_images', 'parse_file_links', 'parse_external_links',
+             'parse_underline', 'parse_monospaced', 'parse_variables',
+             'parse_links', 'parse_tables')),
+        ('parse_code', ('[[code',), ('restore_verbatim',)),
+        ('parse_math', ('[[math',), ('restore_verbatim',)),
+        ('parse_escapes', ('``',), ('restore_verbatim',)),
+    ]
+
+    def __init__(self, filepath, options, content=None):
+        '''Read the page from filepath, or take its content if given.
+
+        options is a ConversionProfile or a dict of options for one. With
+        options['binary'] set, or if content is bytes, the page is
+        converted as utf-8 encoded bytes; see _re(), _lit() and _str().
+        '''
         self.filepath = filepath
-        self.options = options
-
-        try:
-            if self.options['debug'] != False:
-                self.options['debug'] = True
-        except KeyError:
-                self.options['debug'] = False
+        # options may be a plain dict, a profile is made from it then
+        self.options = ConversionProfile.of(options)
+        self.link_filter = self.options.link_filter
 
-        try:
-            if self.options['filelocation'] == '':
-                self.options['filelocation'] = '%s'
-        except KeyError:
-                self.options['filelocation'] = '%s'
-
-        try:
-            if self.options['imagelocation'] == '':
-                self.options['imagelocation'] = '%s'
-        except KeyError:
-                self.options['imagelocation'] = '%s'
-
-        try:
-            if callable(self.options['link_filter']):
-                self.link_filter = self.options['link_filter']
-        except KeyError:
-            self.link_filter = (lambda url,text,linktype: (url, text))
+        self.log = self.options.get('log')
+        # (kind, fields) of what probably did not convert well, see warn()
+        self.warnings = []
+        self.verbatim_dict = {}
+        # the images and files the page refers to, see _add_asset()
+        self.assets = []
+        # the headings of the page, see parse_headings()
+        self.outline = []
+        self.binary = bool(self.options.get('binary')) or isinstance(content, bytes)
+        self.return_bytes = isinstance(content, bytes)
 
         self.extended_start = False
         self.extended_end = False
 
+        if content is not None:
+            # content given directly: filepath is only used for {$page}, the
+            # converted page is returned instead of written out.
+            self.content = self._from_str(content).replace(self._lit('\r\n'), self._lit('\n'))
+            self.page_filepath = filepath
+            self.filepath = None
+            return
+
         try:
-            # the 'rU' mode should convert any \r\n to plain \n.
-            self.content = open(filepath, 'rU').read()
-        except (OSError, FileNotFoundError):
-            self.content = filepath.replace('\r\n', '\n')
+            # universal newlines mode (the default) converts any \r\n to plain \n.
+            infile = open(filepath, 'rb') if self.binary else open(filepath)
+        except (OSError, ValueError):
+            # no such file (ValueError: not even a path, e.g. with NUL
+            # characters): filepath is the page content
+            self.content = self._from_str(filepath).replace(self._lit('\r\n'), self._lit('\n'))
             self.filepath = None
+        else:
+            # a file which is not utf-8 is an error, not page content
+            with infile:
+                self.content = infile.read()
+            if self.binary:
+                self.content = self.content.replace(b'\r\n', b'\n')
+        self.page_filepath = self.filepath
 
     def run(self):
+        if self.log is None:
+            self.run_regexps()
+            return self.write_output()
+        started = time.time()
+        bytes_in = _size(self.content)
         self.run_regexps()
+        seconds = time.time() - started
+        self.log.page(self.page_filepath, bytes_in, _size(self.content),
+                      seconds, len(self.warnings))
         return self.write_output()
 
+    def _re(self, pattern):
+        '''pattern, compiled for the type of the content.'''
+        return _compile(pattern, self.binary)
+
+    def _lit(self, text):
+        '''A literal as the type of the content: utf-8 encoded in binary mode.
+
+        The encoded literals are cached, use _from_str() for anything else.
+        '''
+        if not self.binary or isinstance(text, bytes):
+            return text
+        try:
+            return _literals[text]
+        except KeyError:
+            _literals[text] = text.encode('utf-8')
+            return _literals[text]
+
+    def _from_str(self, text):
+        '''Text built from _str() pieces, as the type of the content.'''
+        if self.binary and not isinstance(text, bytes):
+            return text.encode('utf-8')
+        return text
+
+    def _str(self, value):
+        '''A piece of the content as str, for everything outside the pipeline.'''
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        return value
+
+    def debug(self, message):
+        '''Debug output, to the log if there is one, else to stderr.'''
+        if not self.options['debug']:
+            return
+        message = self._str(message)
+        if self.log is not None:
+            self.log.debug(self.page_filepath, message)
+        else:
+            print(message, file=sys.stderr)
+
+    def warn(self, kind, matchobj, **fields):
+        '''Record something that probably did not convert well, found at matchobj.'''
+        for key, value in fields.items():
+            fields[key] = self._str(value)
+        self._warnings_for(matchobj).append((kind, fields))
+        if self.log is not None:
+            self.log.warning(self._filepath_for(matchobj), kind, **fields)
+
+    def _add_asset(self, matchobj, kind, filename, url, width=None, height=None):
+        '''Record an image or file the page refers to, once per page.
+
+        filename is the name used in the page (and in the export's files
+        directory), url where the converted page points to.
+        '''
+        assets = self._assets_for(matchobj)
+        for asset in assets:
+            if asset['type'] == kind and asset['filename'] == filename:
+                return
+        assets.append({'type': kind,
+                       'filename': filename,
+                       'url': url,
+                       'width': width,
+                       'height': height})
+
+    def _assets_for(self, matchobj):
+        '''The asset list of the page matchobj is in.'''
+        return self.assets
+
+    def _asset_lists(self):
+        return [self.assets]
+
+    def _outline_for(self, matchobj):
+        '''The outline of the page matchobj is in.'''
+        return self.outline
+
+    def _warnings_for(self, matchobj):
+        '''The warnings of the page matchobj is in.'''
+        return self.warnings
+
+    def _filepath_for(self, matchobj):
+        '''The filepath of the page matchobj is in.'''
+        return self.page_filepath
 
     def extend_edges(self):
         '''Make sure the content starts and ends with a newline.
 
         This is to simplify our regexp matching patterns.
         '''
-        if not self.content.startswith('\n'):
-            self.content = '\n' + self.content
+        if not self.content.startswith(self._lit('\n')):
+            self.content = self._lit('\n') + self.content
             self.extended_start = True
-        if not self.content.endswith('\n\n'):
-            self.content = self.content + '\n\n'
+        if not self.content.endswith(self._lit('\n\n')):
+            self.content = self.content + self._lit('\n\n')
             self.extended_end = True
 
     def restore_edges(self):
-        if self.extended_start:
+        # passes may have eaten some of the added newlines, so only remove
+        # what is left of them instead of cutting off page content.
+        newline = self._lit('\n')
+        if self.extended_start and self.content.startswith(newline):
             self.content = self.content[1:]
         if self.extended_end:
-            self.content = self.content[:-2]
+            for _ in range(2):
+                if self.content.endswith(newline):
+                    self.content = self.content[:-1]
 
     def run_regexps(self):
-        '''Run some regexps on the source.'''
+        '''Run the registered passes on the source, in dependency order.
+
+        Passes whose trigger does not occur in the content are skipped.
+        '''
         self.extend_edges()
-        self.extract_verbatim() # take out code and escapes
-        self.remove_misc()
-        self.parse_ulists()
-        self.parse_olists()
-        self.parse_headings()
-        self.parse_italics()
-        self.parse_images()
-        self.parse_file_links()
-        self.parse_external_links()
-        self.parse_underline()
-        self.parse_monospaced()
-        self.parse_variables()
-        # self.parse_includes()
-        self.parse_links()
-        self.parse_tables()
-        self.restore_verbatim() # restore code and escapes
-        self.parse_code()
-        self.parse_math()
-        self.parse_escapes()
+        functions = self.pass_functions()
+        for name, trigger in self.options.pass_order(type(self), self.binary):
+            if trigger is not None and not any(t in self.content for t in trigger):
+                continue
+            function = functions.get(name)
+            if function is None:
+                getattr(self, name)()
+            else:
+                function(self)
         self.restore_edges()
 
+    @classmethod
+    def register_pass(cls, name, function=None, trigger=None, after=(), before=()):
+        '''Add a conversion pass to this class and its subclasses, including
+        the ones that registered passes of their own.
+
+        function takes the converter and changes its content; without one,
+        the method called name is run. In binary mode, the content is bytes:
+        converter._re() and converter._lit() give patterns and literals of
+        the right type. trigger is a sequence of substrings
+        of which at least one has to be in the content for the pass to run,
+        or None to run it on every page. after and before name the passes it
+        has to run after and before; apart from that, the passes of base
+        classes run first, and the others in the order they were registered
+        in. A pass registered on a base class also runs in the subclasses
+        defined before it, like WikispacesToHtmlConverter.
+
+        Example: add a pass which converts [[rss ...]] tags, after the
+        verbatim sections are out of the way, but before links are parsed:
+
+            def parse_rss(converter):
+                pattern = converter._re(r'\\[\\[rss url="(.*?)".*?\\]\\]')
+                converter.content = pattern.sub(converter._lit(r'<\\1>'), converter.content)
+
+            WikispacesToMarkdownConverter.register_pass('parse_rss', parse_rss,
+                    trigger=['[[rss'], after=['extract_verbatim'], before=['parse_links'])
+        '''
+        registration = (name, tuple(trigger) if trigger is not None else None,
+                        tuple(after), tuple(before), function)
+        # check it against every class that is going to run it
+        classes = [cls]
+        for klass in classes:
+            classes.extend(klass.__subclasses__())
+        for klass in classes:
+            names = [passname for passname, _, _ in klass._merge_passes()[0]]
+            if name in names:
+                raise ValueError("pass '{}' is already registered".format(name))
+            for dependency in list(after) + list(before):
+                if dependency not in names:
+                    raise ValueError("unknown pass '{}'".format(dependency))
+            klass._sort_passes(klass._merge_passes([registration])[0])
+
+        # assign instead of changing in place, the pass orders are cached
+        # for the tuples they were merged from
+        cls._registered_passes = cls.__dict__.get('_registered_passes', ()) + (registration,)
+
+    @classmethod
+    def _merge_passes(cls, extra=()):
+        '''The built-in passes with the ones registered on cls and its base
+        classes (base classes first), and the functions of the latter.'''
+        passes = list(cls.passes)
+        functions = {}
+        registrations = [registration for klass in reversed(cls.__mro__)
+                         for registration in klass.__dict__.get('_registered_passes', ())]
+        for name, trigger, after, before, function in registrations + list(extra):
+            passes = [(passname, passtrigger, passafter + (name,) if passname in before else passafter)
+                      for passname, passtrigger, passafter in passes]
+            passes.append((name, trigger, after))
+            if function is not None:
+                functions[name] = function
+        return passes, functions
+
+    @classmethod
+    def pass_order(cls, binary=False):
+        '''The (name, trigger) of all passes, in the order they run in.
+
+        With binary set, the triggers are utf-8 encoded.
+        '''
+        return cls._pass_cache()[1][binary]
+
+    @classmethod
+    def pass_functions(cls):
+        '''The functions given to register_pass(), by pass name.'''
+        return cls._pass_cache()[2]
+
+    @classmethod
+    def _pass_cache(cls):
+        # cached per class, for the lists it was merged from: a pass
+        # registered on a base class replaces the tuple its subclasses use
+        sources = [cls.passes] + [klass.__dict__['_registered_passes'] for klass in reversed(cls.__mro__)
+                                  if '_registered_passes' in klass.__dict__]
+        cached = cls.__dict__.get('_pass_orders')
+        if (cached is None or len(cached[0]) != len(sources)
+                or any(a is not b for a, b in zip(cached[0], sources))):
+            passes, functions = cls._merge_passes()
+            order = cls._sort_passes(passes)
+            encoded = [(name, tuple(t.encode('utf-8') for t in trigger) if trigger is not None else None)
+                       for name, trigger in order]
+            cached = (sources, {False: order, True: encoded}, functions)
+            cls._pass_orders = cached
+        return cached
+
+    @staticmethod
+    def _sort_passes(passes):
+        '''Order the passes so that every one runs after its dependencies.
+
+        Otherwise, passes keep the order they were registered in.
+        '''
+        done = set()
+        order = []
+        remaining = list(passes)
+        while remaining:
+            for i, (name, trigger, after) in enumerate(remaining):
+                if done.issuperset(after):
+                    break
+            else:
+                raise ValueError("cyclic pass dependencies: {}".format(
+                        ', '.join(name for name, _, _ in remaining)))
+            del remaining[i]
+            done.add(name)
+            order.append((name, trigger))
+        return order
+
     def remove_misc(self):
         ''' Gives an easy way to detect converter type'''
-        self.content = self.content.replace('[[WikiText]]', '[{}-{}]'.format(VersionInfo().shortname, VersionInfo().version))
+        self.content = self.content.replace(self._lit('[[WikiText]]'), self._lit('[{}-{}]'.format(VersionInfo().shortname, VersionInfo().version)))
+
+        if self.options.get('toc'):
+            # [[toc]] is left to parse_toc(), [[#Blah]] named anchors become
+            # html anchors
+            def anchor_replace(matchobj):
+                name = self._unescape(self._str(matchobj.group(2))).replace('&', '&amp;').replace('"', '&quot;')
+                return matchobj.group(1) + self._from_str('<a id="{}"></a>'.format(name)) + matchobj.group(3)
+            self.content = self._re(Patterns.anchor).sub(anchor_replace, self.content)
+            return
 
         '''remove the [[toc]] since markdown does it by default'''
-        self.content = re.sub(r'\n?\[\[toc(\|flat)?\]\]', r'', self.content)
+        self.content = self._re(Patterns.toc).sub(self._lit(r''), self.content)
 
         ''' remove [[#Blah]] named anchors '''
-        self.content = re.sub(r'( *)\[\[#.*?\]\]( *)', ' ' * min(1, len(r'\1\2')), self.content)
-
+        self.content = self._re(Patterns.anchor).sub(self._lit(' ' * min(1, len(r'\1\2'))), self.content)
+
+
+    def parse_lists(self):
+        """change unordered (*) and ordered (#) lists, nested or mixed.
+
+        Works line by line and keeps a stack of the list types of the
+        enclosing items, so that every item is indented to start under the
+        text of its parent: two spaces for a '* ' parent, three for '1. '.
+        Only the leading markers which match the stack are parents; where
+        the parent of an item is missing (like '** b' as the first item, or
+        '## b' after '* a'), the item goes where that parent would be, as
+        Markdown has no item without a parent. A line that is not a list item
+        ends the list. '+' is accepted as an unordered marker, too.
+
+        This has to occur before parse_headings(), which introduces '#' again.
+        """
+        L = self._lit
+        separator, space, blanks, markerchars = L(PAGE_SEPARATOR), L(' '), L(' \t'), L('*#+')
+        # single characters of the content: str, or int for bytes
+        ordered = markerchars[1]
+        lines = self.content.split(L('\n'))
+        # (list type, indentation of the item text) per level
+        stack = []
+        for i, line in enumerate(lines):
+            prefix = L('')
+            if line.startswith(separator):
+                # first line of the next page of a batch
+                prefix, line = separator, line[1:]
+                stack = []
+            item = line.lstrip(space)
+            if not item or item[:1] not in markerchars:
+                stack = []
+                continue
+            depth = len(item) - len(item.lstrip(markerchars))
+            if not item[depth:depth + 1] or item[depth:depth + 1] not in blanks:
+                # **bold** and the like
+                stack = []
+                continue
+            markers = item[:depth].replace(L('+'), L('*'))
+            common = 0
+            while common < min(len(stack), depth - 1) and stack[common][0] == markers[common]:
+                common += 1
+            indent = stack[common - 1][1] if common else 0
+            # missing parents take no room
+            stack = stack[:common] + [(kind, indent) for kind in markers[common:depth - 1]]
+            bullet = L('1. ') if markers[-1] == ordered else L('* ')
+            stack.append((markers[-1], indent + len(bullet)))
+            lines[i] = prefix + space * indent + bullet + item[depth:].lstrip(blanks)
+        self.content = L('\n').join(lines)
 
-    def parse_ulists(self):
+    def parse_headings(self):
+        newline, hashmark, space = self._lit("\n"), self._lit('#'), self._lit(" ")
         def do_replace(matchobj):
-            return ('\n  ' * (len(matchobj.group(1)))) + '* '
+            level = min(6, len(matchobj.group(1)))
+            self._add_heading(matchobj, level, matchobj.group(2))
+            return newline + (hashmark * level) + space + matchobj.group(2) + matchobj.group(3)
+        """ change headings. This has to occur after parse_lists()
 
-        self.content = re.sub(r'\n *(\+)\s+', do_replace, self.content)
+        Every heading is added to the outline of the page, for parse_toc().
+        """
+        self.content = self._re(Patterns.heading).sub(do_replace, self.content)
 
-    def parse_olists(self):
-        def do_replace(matchobj):
-            return ('\n  ' * (len(matchobj.group(1)))) + '1. '
+    def _add_heading(self, matchobj, level, text):
+        '''Add a heading to the outline, with a slug unique in the page.
+
+        Returns the slug.
+        '''
+        outline = self._outline_for(matchobj)
+        text = self._heading_text(self._str(text))
+        slug = self.slugify(text)
+        slugs = set(heading['slug'] for heading in outline)
+        if slug in slugs:
+            n = 1
+            while '{}-{}'.format(slug, n) in slugs:
+                n += 1
+            slug = '{}-{}'.format(slug, n)
+        outline.append({'level': level, 'text': text, 'slug': slug})
+        return slug
+
+    def _heading_text(self, text):
+        '''The text of a heading as it reads in the output, without markup.
+
+        Links are reduced to their label, anchors and images left out. The
+        slug and the table of contents are made from this text.
+        '''
+        # anchors as remove_misc() leaves them with options['toc']
+        text = re.sub(r'<a id="[^"]*"></a>', '', text)
+        text = re.sub(r'\[\[(?:image:|#)[^\]]*\]\]', '', text)
+        for pattern in (r'\*\*(.*?)\*\*', Patterns.italics + '(.*?)' + Patterns.italics,
+                        Patterns.underline, Patterns.monospaced):
+            text = re.sub(pattern, r'\1', text)
+        text = re.sub(Patterns.page_link_text, r'\2', text)
+        text = re.sub(r'\[\[(?:file:|@)?([^\]]*)\]\]', r'\1', text)
+        if 'verbatim_placeholder_' in text:
+            text = self._str(self._restore_placeholders(self._from_str(text)))
+            text = re.sub(Patterns.escape, r'\1', text)
+        return ' '.join(text.split())
+
+    @staticmethod
+    def slugify(text):
+        '''The anchor of a heading, like GitHub makes them.
+
+        Lower case, without markup and punctuation, spaces replaced by '-'.
+        '''
+        text = re.sub(r'[^\w\- ]', '', text.strip().lower())
+        return text.replace(' ', '-')
 
-        """ change ordered lists. This has to occur before parse_headings() """
-        self.content = re.sub(r'\n *(\#+)\s+', do_replace, self.content)
+    def parse_toc(self):
+        '''Replace [[toc]] by a table of contents made from the outline.
 
-    def parse_headings(self):
-        def do_replace(matchobj):
-            return "\n" + ('#' * min(6, len(matchobj.group(1)))) + " " + matchobj.group(2) + matchobj.group(3)
-        """ change headings. This has to occur after parse_olists() """
-        self.content = re.sub(r'\n *(=+)\s*(.*?)\s*=+(\s*\n)', do_replace, self.content)
+        Only runs with options['toc'] set, remove_misc() strips the tags
+        otherwise. [[toc]] becomes a nested list of links to the headings,
+        between blank lines, [[toc|flat]] a single line of them.
+        '''
+        newline, separator = self._lit('\n'), self._lit(PAGE_SEPARATOR)
+        def toc_replace(matchobj):
+            flat = bool(matchobj.group(1))
+            toc = self._from_str(self._format_toc(self._outline_for(matchobj), flat))
+            at_line_start = matchobj.group(0).startswith(newline)
+            if flat:
+                return newline + toc if at_line_start else toc
+            # a blank line before the list, unless there is one already, and
+            # one after it, so that the next line does not continue the last item
+            start = matchobj.start()
+            before = matchobj.string[max(start - 1, 0):start]
+            if at_line_start and before in (newline, separator, newline[:0]):
+                return newline + toc + newline
+            return newline + newline + toc + newline
+        self.content = self._re(Patterns.toc).sub(toc_replace, self.content)
+
+    def _format_toc(self, outline, flat):
+        links = [self._format_link('#' + heading['slug'], heading['text']) for heading in outline]
+        if flat:
+            return ' | '.join(links)
+        top = min([heading['level'] for heading in outline] or [1])
+        lines = ['  ' * (heading['level'] - top) + '* ' + link
+                 for heading, link in zip(outline, links)]
+        return '\n'.join(lines)
 
     def parse_italics(self):
         """change italics from // to * """
-        self.content = re.sub(r'(?<!http:)(?<!https:)(?<!ftp:)//', r"*", self.content)
+        self.content = self._re(Patterns.italics).sub(self._lit(r"*"), self.content)
 
     def _link_filter(self, m, linktype = 'page', grouporder = (1,2)):
         linktypes = ['page', 'external', 'file', 'image', 'imagelink']
         if not linktype in linktypes:
             raise ValueError("linktype '{}' not one of [{}]".format(linktype, ', '.join(linktypes)))
-        url = m.group(grouporder[0])
+        url = self._str(m.group(grouporder[0]))
         try:
-            text = m.group(grouporder[1])
+            text = self._str(m.group(grouporder[1]))
         except IndexError:
             text = url
+        # the link filter and the assets get the name as it is in the page
+        url = self._unescape(url)
 
-        ret = self.link_filter(url, text, linktype)
-        try:
-            returl, rettext = ret
-        except ValueError:
-            returl = ret
-            rettext = returl
+        returl, rettext = self.link_filter(url, text, linktype)
 
         if linktype == 'file':
-            returl = self.options['filelocation'].replace('%s', returl)
+            returl = self.options.file_url(returl)
+            self._add_asset(m, 'file', url, returl)
 
         if linktype == 'image':
-            returl = self.options['imagelocation'].replace('%s', returl)
+            returl = self.options.image_url(returl)
+
+        return self._from_str(self._format_link(returl, rettext))
+
+    def _format_link(self, url, text):
+        return "[{}]({})".format(text, url)
 
-        return "[{}]({})".format(rettext, returl)
+    @staticmethod
+    def _unescape(text):
+        '''text from the content as it is in the page; see WikispacesToHtmlConverter.'''
+        return text
 
     def _link_filter_page(self, m):
         return self._link_filter(m, linktype='page', grouporder=(1,2))
@@ -232,12 +1228,12 @@ class WikispacesToMarkdownConverter:
         braces, since that produces the equivalent output in markdown.
         '''
         # change external link format
-        self.content = re.sub(r'\[\[@?(https?://[^|\]]*)\|([^\]]*)\]\]', self._link_filter_external, self.content)
-        self.content = re.sub(r'\[\[@?(ftp://[^|\]]*)\|([^\]]*)\]\]', self._link_filter_external, self.content)
+        self.content = self._re(Patterns.external_link_text).sub(self._link_filter_external, self.content)
+        self.content = self._re(Patterns.ftp_link_text).sub(self._link_filter_external, self.content)
 
         # free naked external links
-        self.content = re.sub(r'\[\[@?(https?://[^|\]]*)\]\]', self._link_filter_external, self.content)
-        self.content = re.sub(r'\[\[@?(ftp://[^|\]]*)\]\]', self._link_filter_external, self.content)
+        self.content = self._re(Patterns.external_link).sub(self._link_filter_external, self.content)
+        self.content = self._re(Patterns.ftp_link).sub(self._link_filter_external, self.content)
 
     def parse_file_links(self):
         '''change file link format to external links.
@@ -247,8 +1243,8 @@ class WikispacesToMarkdownConverter:
         location of file is specified with cli argument.
         '''
         # change [[file:...]] links to external links
-        self.content = re.sub(r'\[\[file:([^|\]]*)\|([^\]]*)\]\]', self._link_filter_file, self.content)
-        self.content = re.sub(r'\[\[file:([^|\]]*)\]\]', self._link_filter_file, self.content)
+        self.content = self._re(Patterns.file_link_text).sub(self._link_filter_file, self.content)
+        self.content = self._re(Patterns.file_link).sub(self._link_filter_file, self.content)
 
     def parse_links(self):
         # change [[...]] and [[...|...]] links
@@ -256,27 +1252,35 @@ class WikispacesToMarkdownConverter:
         #self.content = re.sub(r'\[\[([^|\]]*)\|([^\]]*)\]\]', r'[\2](\1)', self.content)
         #self.content = re.sub(r'\[\[([^|\]]*)\]\]', r'[\1](\1)', self.content)
         # TODO: Check if this working not just for gollum, but also for gh-pages jekyll
-        self.content = re.sub(r'\[\[([^|\]]*)\|([^\]]*)\]\]', self._link_filter_page, self.content)
-        self.content = re.sub(r'\[\[([^|\]]*)\]\]', self._link_filter_page, self.content)
+        self.content = self._re(Patterns.page_link_text).sub(self._link_filter_page, self.content)
+        self.content = self._re(Patterns.page_link).sub(self._link_filter_page, self.content)
+        if self._lit('[[') in self.content:
+            for matchobj in self._re(r'\[\[[^\n\x00]{0,40}').finditer(self.content):
+                # verbatim sections are still out, put them back for the log
+                self.warn('unresolved_link', matchobj, text=self._restore_placeholders(matchobj.group(0)))
 
     def parse_underline(self):
         """change underline from __ to _ """
-        self.content = re.sub(r'(?s)__(.*?)__', r'_\1_', self.content)
+        self.content = self._re(Patterns.underline).sub(self._lit(r'_\1_'), self.content)
 
     def parse_monospaced(self):
         """change monospaced font from {{}} to `` """
-        self.content = re.sub(r'(?s){{(.*?)}}', r'`\1`', self.content)
+        self.content = self._re(Patterns.monospaced).sub(self._lit(r'`\1`'), self.content)
 
     def parse_variables(self):
         """Parse variables.
 
         The only variable currently supported is {$page}"""
-        self.content = re.sub(r'{\$page}', os.path.basename(self.filepath) if not self.filepath is None else '', self.content)
+        self.content = self._replace_variables(self.content, self.page_filepath)
+
+    def _replace_variables(self, content, filepath):
+        pagename = os.path.basename(filepath) if not filepath is None else ''
+        return content.replace(self._lit('{$page}'), self._from_str(pagename))
 
     def parse_includes(self):
         # TODO
         """change includes from [[include...]] to {{}}"""
-        self.content = re.sub(r'\[\[include page="([^"]*?)"[^\]]*?\]\]', r'{{:\1}}', self.content)
+        self.content = self._re(Patterns.include).sub(self._lit(r'{{:\1}}'), self.content)
 
     def parse_code(self):
         '''convert the [[code]] tags to <pre> tags.
@@ -289,25 +1293,25 @@ class WikispacesToMarkdownConverter:
 
         maybe will add optional support for that with an extra cli option.
         '''
+        L = self._lit
         def code_replace(matchobj):
             code = matchobj.group(2)
             if matchobj.group(1):
-                lang = re.sub(r' +format="(.*?)"', r'\1', matchobj.group(1)).lower()
+                lang = self._re(r' +format="(.*?)"').sub(L(r'\1'), matchobj.group(1)).lower()
             else:
-                lang = ''
-            if self.options['debug']:
-                print(code)
-            return '```' + lang + "\n" + code + "\n```\n"
-        self.content = re.sub(r'(?s)\[\[code( +format=".*?")?\]\](.*?)\[\[code\]\]', code_replace, self.content)
+                lang = L('')
+            self.debug(code)
+            return L('```') + lang + L("\n") + code + L("\n```\n")
+        self.content = self._re(Patterns.code).sub(code_replace, self.content)
 
     def parse_math(self):
         '''convert the [[math]] tags to <math> tags.'''
+        L = self._lit
         def math_replace(matchobj):
             code = matchobj.group(2)
-            if self.options['debug']:
-                print(code)
-            return '<math>' + code + '</math>'
-        self.content = re.sub(r'(?s)\[\[math( +format=".*?")?\]\](.*?)\[\[math\]\]', math_replace, self.content)
+            self.debug(code)
+            return L('<math>') + code + L('</math>')
+        self.content = self._re(Patterns.math).sub(math_replace, self.content)
 
     def parse_images(self):
         '''convert [[image:...]] tags to [[File:...]] tags.
@@ -320,9 +1324,8 @@ class WikispacesToMarkdownConverter:
         http://www.wikispaces.com/image+tags
         '''
         def image_parse(matchobj):
-            imagetag = matchobj.group(0)[:-2]
-            if self.options['debug']:
-                print(imagetag)
+            imagetag = self._unescape(self._str(matchobj.group(0))[:-2])
+            self.debug(imagetag)
             image_filename = re.search(r'\[\[image:([^ ]*)', imagetag).group(1)
 
             try:
@@ -350,104 +1353,1043 @@ class WikispacesToMarkdownConverter:
             except AttributeError:
                 image_link = ''
 
+            source_filename = image_filename
             image_filename, image_comment = self.link_filter(image_filename, image_comment, 'image')
             if (image_filename[:7] != 'http://') and (image_filename[:8] != 'https://'):
-                image_filename = self.options['imagelocation'].replace('%s', image_filename)
+                image_filename = self.options.image_url(image_filename)
+            self._add_asset(matchobj, 'image', source_filename, image_filename,
+                            int(image_width) if image_width else None,
+                            int(image_height) if image_height else None)
 
-            if image_link == '':
-                return '![%s](%s)' % (image_comment, image_filename)
-            else:
-                return '![%s](%s)(%s)' % (image_comment, image_filename, image_link)
+            return self._from_str(self._format_image(image_filename, image_comment, image_link,
+                                                     image_width, image_height, image_align))
 
-        self.content = re.sub(r'\[\[image:[^\]]+\]\]', image_parse, self.content)
+        self.content = self._re(Patterns.image).sub(image_parse, self.content)
 
-    def parse_tables(self):
-        '''convert wikispaces tables to markdown tables.'''
-        # FIXME: Make more robust, eg. by getting number of columns from 1st row, then readjusting line breaks for the following table rows
-        def replace_tables(matchobj):
-            atable = matchobj.group(0)
-            rows = atable.split('||\n')
-            for i, row in enumerate(rows):
-                if not row.endswith('||'):
-                    rows[i] = row + '||'
-
-            output_table = ''
-
-            rownum = 0
-            celltypes = []
-            for row in rows:
-                output_row = '|'
-
-                cells = re.findall(r'(?s)(?<=\|\|)(.*?)(?=\|\|)', row)
-                for cell in cells:
-                    if cell.startswith('='):
-                        # centered cell
-                        cell_type = ':----:'
-                        cell = cell[1:]
-                    elif cell.startswith('>'):
-                        # right aligned
-                        cell_type = '----:'
-                        cell = cell[1:]
-                    elif cell.startswith('~'):
-                        # table heading cell
-                        cell_type = '----'
-                        cell = cell[1:]
-                    else:
-                        cell_type = '----'
-
-                    if rownum == 0:
-                        celltypes += [cell_type]
-                    output_row += cell + '|'
-
-                output_table += output_row + '\n'
-                if rownum == 0:
-                    output_table += '|' + ("|".join(celltypes)) + '|\n'
-
-                rownum += 1
+    def _format_image(self, filename, comment, link, width, height, align):
+        if link == '':
+            return '![%s](%s)' % (comment, filename)
+        else:
+            return '![%s](%s)(%s)' % (comment, filename, link)
 
-            return output_table
+    def parse_tables(self):
+        '''convert wikispaces tables to markdown tables.
 
-        self.content = re.sub(r'(?s)(?<=\n)([|][|].*?[|][|])(?=\n[^|]|\n[|][^|])',
-                replace_tables, self.content)
+        Tables are converted row by row, straight from the content: rows and
+        cells are found by position, without splitting the table up, and
+        the cells and markup are appended to the pieces the new content is
+        joined from. Besides the content and its converted copy, only the
+        slices of the cells are held; there is no per-table buffer.
+        '''
+        # FIXME: Make more robust, eg. by getting number of columns from 1st row, then readjusting line breaks for the following table rows
+        content = self.content
+        pieces = []
+        position = 0
+        for matchobj in self._re(Patterns.table).finditer(content):
+            pieces.append(content[position:matchobj.start()])
+            self._format_table(self._table_rows(content, matchobj.start(), matchobj.end()), matchobj, pieces)
+            position = matchobj.end()
+        if pieces:
+            pieces.append(content[position:])
+            self.content = self._lit('').join(pieces)
+
+    def _table_rows(self, content, start, end):
+        '''The rows of the table content[start:end], as lists of (kind, text)
+        cells, one row at a time.
+
+        kind is the prefix of the cell: '=' centered, '>' right aligned,
+        '~' heading, or empty.
+        '''
+        L = self._lit
+        kinds = (L('='), L('>'), L('~'))
+        row_end, cell_end = L('||\n'), L('||')
+        cell_pattern = self._re(r'(?s)(?<=\|\|)(.*?)(?=\|\|)')
+        while start < end:
+            # a row runs up to the next '||\n', and always ends with '||'
+            stop = content.find(row_end, start, end)
+            if stop == -1:
+                stop = next_start = end
+            else:
+                next_start = stop + len(row_end)
+                if not content.endswith(cell_end, start, stop):
+                    stop += len(cell_end)
+            cells = []
+            for matchobj in cell_pattern.finditer(content, start, stop):
+                cell = matchobj.group(1)
+                if cell[:1] in kinds:
+                    cells.append((cell[:1], cell[1:]))
+                else:
+                    cells.append((L(''), cell))
+            yield cells
+            start = next_start
+
+    def _format_table(self, rows, matchobj, output):
+        '''Append the rows of the table at matchobj to the output list,
+        taking the column alignment from the first row.'''
+        L = self._lit
+        alignments = {L('='): L(':----:'), L('>'): L('----:')}
+        separator, newline = L('|'), L('\n')
+        write = output.append
+        celltypes = []
+        for rownum, cells in enumerate(rows):
+            write(separator)
+            for _, text in cells:
+                write(text)
+                write(separator)
+            write(newline)
+            if rownum == 0:
+                celltypes = [alignments.get(kind, L('----')) for kind, _ in cells]
+                write(separator + separator.join(celltypes) + L('|\n'))
+            elif len(cells) != len(celltypes):
+                self.warn('table_columns', matchobj, row=rownum, cells=len(cells), columns=len(celltypes))
 
     def extract_verbatim(self):
         '''Take out sections that should remain unparsed.
 
         Store them in a dict, leave placeholders in content.
         '''
+        import random
         self.verbatim_dict = {}
         def replace_verbatim(matchobj):
             while True:
-                key = 'verbatim_placeholder_' + str(random.randint(1, 1e15))
+                key = self._from_str('verbatim_placeholder_%015d' % random.randint(1, 10**15 - 1))
                 if key not in self.verbatim_dict.keys():
                     break
             self.verbatim_dict[key] = matchobj.group(0)
             return key
 
-        self.content = re.sub(r'(?s)\n?\[\[code( +format=".*?")?\]\](.*?)\[\[code\]\]\n?', replace_verbatim, self.content)
-        self.content = re.sub(r'``(.*)``', replace_verbatim, self.content)
-        self.content = re.sub(r'(?s)\[\[math( +format=".*?")?\]\](.*?)\[\[math\]\]', replace_verbatim, self.content)
+        self.content = self._re(r'\n?' + Patterns.code + r'\n?').sub(replace_verbatim, self.content)
+        self.content = self._re(Patterns.escape).sub(replace_verbatim, self.content)
+        self.content = self._re(Patterns.math).sub(replace_verbatim, self.content)
 
     def restore_verbatim(self):
         '''Restore verbatim sections taken out by extract_verbatim.'''
-        for key in self.verbatim_dict.keys():
-            self.content = self.content.replace(key, self.verbatim_dict[key])
+        if self.verbatim_dict:
+            self.content = self._restore_placeholders(self.content)
+            # asset names are taken before the restore, they may have some too
+            for assets in self._asset_lists():
+                for asset in assets:
+                    for field in ('filename', 'url'):
+                        if 'verbatim_placeholder_' in asset[field]:
+                            asset[field] = self._str(self._restore_placeholders(self._from_str(asset[field])))
+
+    def _restore_placeholders(self, value):
+        '''value with the verbatim sections in it put back.'''
+        # all placeholders have the same length, so a single substitution
+        # finds them without mistaking one key for the prefix of another.
+        # Sections can be nested (code inside an escape), hence the recursion.
+        def replace_placeholder(matchobj):
+            key = matchobj.group(0)
+            if key not in self.verbatim_dict:
+                return key
+            return placeholder.sub(replace_placeholder, self.verbatim_dict[key])
+
+        placeholder = self._re(r'verbatim_placeholder_\d{15}')
+        return placeholder.sub(replace_placeholder, value)
 
     def parse_escapes(self):
         '''Replace escapes '``' with '`' tags.'''
-        self.content = re.sub(r'``(.*)``', r'`\1`', self.content)
+        self.content = self._re(Patterns.escape).sub(self._lit(r'`\1`'), self.content)
+
+    # appended to the filepath of a page for the one of its output
+    output_suffix = '_markdown'
+
+    @classmethod
+    def output_filepath(cls, filepath):
+        return os.path.join(os.path.dirname(filepath),
+                            os.path.basename(filepath) + cls.output_suffix)
 
     def write_output(self):
         if not self.filepath is None:
 
-            output_filepath = os.path.join(os.path.dirname(self.filepath),
-                                os.path.basename(self.filepath) + '_markdown')
+            output_filepath = self.output_filepath(self.filepath)
 
-            open(output_filepath, 'w').write(self.content)
+            open(output_filepath, 'wb' if self.binary else 'w').write(self.content)
+            return output_filepath
+        elif self.binary and not self.return_bytes:
+            return self.content.decode('utf-8')
         else:
             return self.content
 
 
+class WikispacesToHtmlConverter(WikispacesToMarkdownConverter):
+    '''Converts to HTML instead of Markdown, with the same passes.
+
+    The passes that produce markup are overridden; escape_html, parse_bold
+    and parse_paragraphs are added, see the register_pass() calls below.
+    Select it with options['format'] = 'html' (--format html).
+    '''
+    output_suffix = '_html'
+
+    def escape_html(self):
+        '''Escape & and < in the text, before any tags are put in.'''
+        self.content = self.content.replace(self._lit('&'), self._lit('&amp;')).replace(self._lit('<'), self._lit('&lt;'))
+
+    @staticmethod
+    def _escape(text):
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    @staticmethod
+    def _unescape(text):
+        # names (of links, images, anchors) are taken from the escaped
+        # content, but have to be passed on as they are in the page
+        return text.replace('&lt;', '<').replace('&amp;', '&')
+
+    @classmethod
+    def _attribute(cls, value):
+        return cls._escape(value).replace('"', '&quot;')
+
+    def parse_lists(self):
+        '''Change unordered (*) and ordered (#) lists to nested <ul> and <ol>.
+
+        Works line by line like WikispacesToMarkdownConverter.parse_lists();
+        tags closing a list item go to the end of the line before.
+        '''
+        L = self._lit
+        separator, space, blanks, markerchars = L(PAGE_SEPARATOR), L(' '), L(' \t'), L('*#+')
+        ordered = markerchars[1]
+        lines = self.content.split(L('\n'))
+        stack = []
+        def close(depth):
+            # close the lists deeper than depth, and the item at depth
+            closing = L('').join(L('</li></ol>') if kind == ordered else L('</li></ul>')
+                                 for kind in reversed(stack[depth:]))
+            del stack[depth:]
+            return closing
+        for i, line in enumerate(lines):
+            prefix = L('')
+            if line.startswith(separator):
+                prefix, line = separator, line[1:]
+            item = line.lstrip(space)
+            depth = len(item) - len(item.lstrip(markerchars)) if item[:1] in markerchars else 0
+            if depth and not (item[depth:depth + 1] and item[depth:depth + 1] in blanks):
+                # **bold** and the like
+                depth = 0
+            if prefix or not depth:
+                if stack:
+                    lines[i - 1] += close(0)
+                if not depth:
+                    continue
+            markers = item[:depth].replace(L('+'), L('*'))
+            kinds = list(markers)
+            common = 0
+            while common < min(len(stack), depth) and stack[common] == kinds[common]:
+                common += 1
+            opening = L('')
+            if common == depth:
+                lines[i - 1] += close(depth) + L('</li>')
+                opening = L('<li>')
+            else:
+                if len(stack) > common:
+                    lines[i - 1] += close(common)
+                for kind in kinds[common:]:
+                    opening += (L('<ol><li>') if kind == ordered else L('<ul><li>'))
+                    stack.append(kind)
+            lines[i] = prefix + opening + item[depth:].lstrip(blanks)
+        if stack:
+            lines[-1] += close(0)
+        self.content = L('\n').join(lines)
+
+    def parse_headings(self):
+        '''change headings to <h1> to <h6>, with the slug as id.'''
+        def do_replace(matchobj):
+            level = min(6, len(matchobj.group(1)))
+            # the outline has the text as it is in the page
+            slug = self._add_heading(matchobj, level, self._from_str(self._unescape(self._str(matchobj.group(2)))))
+            return self._from_str('\n<h{0} id="{1}">'.format(level, self._attribute(slug))) + matchobj.group(2) + self._from_str('</h{}>'.format(level))
+        self.content = self._re(Patterns.heading).sub(do_replace, self.content)
+
+    def _format_toc(self, outline, flat):
+        links = [self._format_link('#' + heading['slug'], self._escape(heading['text'])) for heading in outline]
+        if flat:
+            return ' | '.join(links)
+        if not outline:
+            return ''
+        top = min(heading['level'] for heading in outline)
+        html = ''
+        depth = 0
+        for heading, link in zip(outline, links):
+            level = heading['level'] - top + 1
+            if level > depth:
+                html += '<ul><li>' * (level - depth)
+            else:
+                html += '</li></ul>' * (depth - level) + '</li><li>'
+            depth = level
+            html += link
+        return html + '</li></ul>' * depth
+
+    def parse_italics(self):
+        '''change italics from //...// to <em>, within a paragraph.'''
+        pattern = Patterns.italics + r'((?:(?!\n\n)[^\x00])*?)' + Patterns.italics
+        self.content = self._re(pattern).sub(self._lit(r'<em>\1</em>'), self.content)
+
+    def parse_bold(self):
+        '''change bold from **...** to <strong>, within a paragraph.'''
+        pattern = r'\*\*((?:(?!\n\n)[^\x00])*?)\*\*'
+        self.content = self._re(pattern).sub(self._lit(r'<strong>\1</strong>'), self.content)
+
+    def _format_link(self, url, text):
+        return '<a href="{}">{}</a>'.format(self._attribute(url), text)
+
+    def _format_image(self, filename, comment, link, width, height, align):
+        image = '<img src="{}" alt="{}"'.format(self._attribute(filename), self._attribute(comment))
+        if width:
+            image += ' width="{}"'.format(width)
+        if height:
+            image += ' height="{}"'.format(height)
+        if align in ('left', 'right'):
+            image += ' style="float: {}"'.format(align)
+        image += '>'
+        if link == '':
+            return image
+        return '<a href="{}">{}</a>'.format(self._attribute(link), image)
+
+    def parse_underline(self):
+        """change underline from __ to <u>"""
+        self.content = self._re(Patterns.underline).sub(self._lit(r'<u>\1</u>'), self.content)
+
+    def parse_monospaced(self):
+        """change monospaced font from {{}} to <code>"""
+        self.content = self._re(Patterns.monospaced).sub(self._lit(r'<code>\1</code>'), self.content)
+
+    def parse_code(self):
+        '''convert the [[code]] tags to <pre><code>, with the language as
+        class, the way highlighters like highlight.js and Prism expect it.'''
+        def code_replace(matchobj):
+            code = self._escape(self._str(matchobj.group(2)).strip('\n'))
+            self.debug(code)
+            if matchobj.group(1):
+                lang = re.sub(r' +format="(.*?)"', r'\1', self._str(matchobj.group(1))).lower()
+                tag = '<pre><code class="language-{}">'.format(self._attribute(lang))
+            else:
+                tag = '<pre><code>'
+            return self._from_str('\n' + tag + code + '</code></pre>\n')
+        self.content = self._re(Patterns.code).sub(code_replace, self.content)
+
+    def parse_math(self):
+        '''convert the [[math]] tags to MathJax style inline math.'''
+        def math_replace(matchobj):
+            code = self._escape(self._str(matchobj.group(2)))
+            self.debug(code)
+            return self._from_str('<span class="math">\\(' + code + '\\)</span>')
+        self.content = self._re(Patterns.math).sub(math_replace, self.content)
+
+    def parse_escapes(self):
+        '''Replace escapes '``' by their (escaped) content.'''
+        def escape_replace(matchobj):
+            return self._from_str(self._escape(self._str(matchobj.group(1))))
+        self.content = self._re(Patterns.escape).sub(escape_replace, self.content)
+
+    def _format_table(self, rows, matchobj, output):
+        L = self._lit
+        tags = {L('~'): (L('<th>'), L('</th>')),
+                L('='): (L('<td style="text-align: center">'), L('</td>')),
+                L('>'): (L('<td style="text-align: right">'), L('</td>'))}
+        cell_tags = (L('<td>'), L('</td>'))
+        # the same whitespace for str and bytes
+        blanks = L(' \t\n\r\f\v')
+        write = output.append
+        write(L('<table>\n'))
+        for cells in rows:
+            write(L('<tr>'))
+            for kind, text in cells:
+                opening, closing = tags.get(kind, cell_tags)
+                write(opening)
+                write(text.strip(blanks))
+                write(closing)
+            write(L('</tr>\n'))
+        write(L('</table>\n'))
+
+    def parse_paragraphs(self):
+        '''Wrap runs of text lines, ended by blank lines or block elements, in <p>.'''
+        L = self._lit
+        separator = L(PAGE_SEPARATOR)
+        block = self._re(r'</?(?:h[1-6]|ul|ol|li|table|tr|pre|div|p|blockquote)\b')
+        lines = self.content.split(L('\n'))
+        in_paragraph = in_pre = False
+        for i, line in enumerate(lines):
+            if line.startswith(separator):
+                line = line[1:]
+                if in_paragraph:
+                    lines[i - 1] += L('</p>')
+                in_paragraph = in_pre = False
+            if in_pre:
+                in_pre = L('</pre>') not in line
+                continue
+            if not line.strip() or block.match(line):
+                if in_paragraph:
+                    lines[i - 1] += L('</p>')
+                    in_paragraph = False
+                in_pre = L('<pre') in line and L('</pre>') not in line
+                continue
+            if not in_paragraph:
+                lines[i] = lines[i][:len(lines[i]) - len(line)] + L('<p>') + line
+                in_paragraph = True
+        if in_paragraph:
+            lines[-1] += L('</p>')
+        self.content = L('\n').join(lines)
+
+WikispacesToHtmlConverter.register_pass('escape_html', trigger=['&', '<'],
+        after=['extract_verbatim'],
+        before=[name for name, _ in WikispacesToHtmlConverter.pass_order() if name != 'extract_verbatim'])
+WikispacesToHtmlConverter.register_pass('parse_bold', trigger=['**'],
+        after=['parse_lists'], before=['restore_verbatim'])
+WikispacesToHtmlConverter.register_pass('parse_paragraphs',
+        after=['parse_code', 'parse_math', 'parse_escapes'])
+
+
+class WikispacesBatchConverter(WikispacesToMarkdownConverter):
+    '''Converts many (small) pages with a single run of every pass.
+
+    The pages are joined with PAGE_SEPARATOR, which none of the patterns
+    match across, so every substitution runs once over the combined buffer
+    instead of once per page. Things that depend on the page, like its edges
+    and {$page}, are handled page by page. Pages containing the separator
+    themselves are converted on their own.
+
+    In binary mode, texts may be str or bytes; every converted page has the
+    type of its text.
+    '''
+    # converts the pages that can not be batched
+    page_class = WikispacesToMarkdownConverter
+
+    def __init__(self, texts, options, filepaths=None):
+        WikispacesToMarkdownConverter.__init__(self, None, options, content='')
+        self.texts = list(texts)
+        if filepaths is None:
+            self.filepaths = [None] * len(self.texts)
+        else:
+            self.filepaths = list(filepaths)
+            if len(self.filepaths) != len(self.texts):
+                raise ValueError("got {} filepaths for {} pages".format(len(self.filepaths), len(self.texts)))
+        self.batched = []
+        self.extended = []
+        # the assets and outline of every page, see WikispacesToMarkdownConverter
+        self.page_assets = [[] for _ in self.texts]
+        self.page_outlines = [[] for _ in self.texts]
+        self.page_warnings = [[] for _ in self.texts]
+        self._separators = (None, [])
+
+    def run(self):
+        '''Convert all pages, return the list of converted pages.'''
+        results = [None] * len(self.texts)
+        self.batched = []
+        separator = self._lit(PAGE_SEPARATOR)
+        for i, text in enumerate(self.texts):
+            if self._from_str(text).find(separator) != -1:
+                wp = self.page_class(self.filepaths[i], self.options, content=text)
+                results[i] = wp.run()
+                self.page_assets[i] = wp.assets
+                self.page_outlines[i] = wp.outline
+                self.page_warnings[i] = wp.warnings
+            else:
+                self.batched.append(i)
+
+        if self.batched:
+            self.content = separator.join(self._from_str(self.texts[i]) for i in self.batched)
+            self.content = self.content.replace(self._lit('\r\n'), self._lit('\n'))
+            started = time.time()
+            self.run_regexps()
+            seconds = time.time() - started
+            self._separators = (None, [])
+            for i, page in zip(self.batched, self.content.split(separator)):
+                results[i] = page if isinstance(self.texts[i], bytes) else self._str(page)
+            if self.log is not None:
+                self.log.batch(len(self.batched), seconds)
+                sizes = [_size(self.texts[i]) for i in self.batched]
+                for i, size, share in zip(self.batched, sizes, _batch_shares(seconds, sizes)):
+                    self.log.page(self.filepaths[i], size, _size(results[i]),
+                                  share, len(self.page_warnings[i]))
+        return results
+
+    def _asset_lists(self):
+        return [self.page_assets[i] for i in self.batched]
+
+    def _assets_for(self, matchobj):
+        return self.page_assets[self._page(matchobj)]
+
+    def _outline_for(self, matchobj):
+        return self.page_outlines[self._page(matchobj)]
+
+    def _warnings_for(self, matchobj):
+        return self.page_warnings[self._page(matchobj)]
+
+    def _filepath_for(self, matchobj):
+        return self.filepaths[self._page(matchobj)]
+
+    def _page(self, matchobj):
+        '''The index of the page (in texts) matchobj is in.'''
+        # matches are positions in the string the substitution started with;
+        # find the page by the separators before it, which are looked up
+        # once per substitution.
+        string = matchobj.string
+        if self._separators[0] is not string:
+            separator = self._lit(PAGE_SEPARATOR)
+            positions = []
+            pos = string.find(separator)
+            while pos != -1:
+                positions.append(pos)
+                pos = string.find(separator, pos + 1)
+            self._separators = (string, positions)
+        import bisect
+        page = bisect.bisect(self._separators[1], matchobj.start())
+        return self.batched[page]
+
+    def extend_edges(self):
+        pages = self.content.split(self._lit(PAGE_SEPARATOR))
+        self.extended = []
+        for i, page in enumerate(pages):
+            self.content = page
+            self.extended_start = self.extended_end = False
+            WikispacesToMarkdownConverter.extend_edges(self)
+            pages[i] = self.content
+            self.extended.append((self.extended_start, self.extended_end))
+        self.content = self._lit(PAGE_SEPARATOR).join(pages)
+
+    def restore_edges(self):
+        pages = self.content.split(self._lit(PAGE_SEPARATOR))
+        for i, page in enumerate(pages):
+            self.content = page
+            self.extended_start, self.extended_end = self.extended[i]
+            WikispacesToMarkdownConverter.restore_edges(self)
+            pages[i] = self.content
+        self.content = self._lit(PAGE_SEPARATOR).join(pages)
+
+    def parse_variables(self):
+        if self._lit('{$page}') not in self.content:
+            return
+        separator = self._lit(PAGE_SEPARATOR)
+        pages = self.content.split(separator)
+        for n, i in enumerate(self.batched):
+            pages[n] = self._replace_variables(pages[n], self.filepaths[i])
+        self.content = separator.join(pages)
+
+
+class WikispacesHtmlBatchConverter(WikispacesBatchConverter, WikispacesToHtmlConverter):
+    '''WikispacesBatchConverter for HTML output.'''
+    page_class = WikispacesToHtmlConverter
+
+
+# output formats: page and batch converter class
+FORMATS = {'markdown': (WikispacesToMarkdownConverter, WikispacesBatchConverter),
+           'html': (WikispacesToHtmlConverter, WikispacesHtmlBatchConverter)}
+
+def converter_class(options, batch=False):
+    '''The converter class for options['format'], markdown by default.'''
+    format = options.get('format') or 'markdown'
+    try:
+        return FORMATS[format][1 if batch else 0]
+    except KeyError:
+        raise ValueError("unknown format '{}', not one of [{}]".format(format, ', '.join(sorted(FORMATS))))
+
+
+def convert_batch(texts, options=None, filepaths=None, assets=None, warnings=None):
+    '''Convert a list of page contents, return the list of converted pages.
+
+    filepaths, if given, holds the filepath (or None) of every page; it is
+    used for {$page} and the log. If assets is a list, the asset list of
+    every page is appended to it, and likewise the (kind, fields) warnings
+    of every page to warnings.
+    '''
+    options = ConversionProfile.of(options)
+    converter = converter_class(options, batch=True)(texts, options, filepaths)
+    results = converter.run()
+    if assets is not None:
+        assets.extend(converter.page_assets)
+    if warnings is not None:
+        warnings.extend(converter.page_warnings)
+    return results
+
+
+def asset_manifest(pages):
+    '''The asset manifest of a batch of converted pages.
+
+    pages is a list of (filepath, assets) pairs, assets being the asset list
+    of a converter. Returns a dict with the asset list of every page under
+    'pages', and under 'assets' every asset once, with the pages using it.
+    '''
+    manifest = {'pages': [], 'assets': []}
+    found = {}
+    for filepath, assets in pages:
+        manifest['pages'].append({'page': filepath, 'assets': assets})
+        for asset in assets:
+            key = (asset['type'], asset['filename'])
+            if key not in found:
+                found[key] = dict(asset, pages=[])
+                manifest['assets'].append(found[key])
+            found[key]['pages'].append(filepath)
+    return manifest
+
+def stage_assets(assets, source_dir, target_dir, hardlink=False, threads=8):
+    '''Copy (or hardlink) the files assets refer to from source_dir, the
+    files directory of a Wikispaces export, to target_dir.
+
+    The files are staged by a pool of threads; files already in target_dir
+    with the same size are left alone, and hardlinks fall back to copies
+    across filesystems. Remote assets (URLs) and filenames pointing outside
+    source_dir are skipped. Returns a dict with the filenames 'staged',
+    'unchanged', 'missing' and 'skipped'.
+    '''
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    def stage(filename):
+        source = os.path.normpath(os.path.join(source_dir, filename))
+        if (os.path.isabs(filename) or '://' in filename
+                or not source.startswith(os.path.normpath(source_dir) + os.sep)):
+            return 'skipped'
+        if not os.path.isfile(source):
+            return 'missing'
+        target = os.path.join(target_dir, os.path.relpath(source, source_dir))
+        if os.path.isfile(target) and os.path.getsize(target) == os.path.getsize(source):
+            return 'unchanged'
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if hardlink:
+            try:
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.link(source, target)
+                return 'staged'
+            except OSError:
+                pass
+        shutil.copy2(source, target)
+        return 'staged'
+
+    filenames = []
+    for asset in assets:
+        if asset['filename'] not in filenames:
+            filenames.append(asset['filename'])
+    result = {'staged': [], 'unchanged': [], 'missing': [], 'skipped': []}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for filename, status in zip(filenames, executor.map(stage, filenames)):
+            result[status].append(filename)
+    return result
+
+
+class WikispacesAnalyzer:
+    '''Counts the markup features pages use, without converting them.
+
+    Meant to be run over a whole wiki before migrating it: the per-page
+    counts show which pages will convert badly (tables, unsupported tags
+    like includes, which are dropped or mangled), the totals what the wiki
+    uses at all.
+    '''
+    features = ['code', 'math', 'escapes', 'headings', 'list_items', 'tables',
+                'images', 'images_with_links', 'file_links', 'external_links',
+                'page_links', 'toc', 'anchors', 'includes', 'variables',
+                'unsupported']
+
+    def __init__(self):
+        self.pages = 0
+        self.errors = 0
+        self.totals = dict((feature, 0) for feature in self.features)
+        self.totals['bytes'] = 0
+        self.totals['lines'] = 0
+        self.unsupported = {}
+
+    def analyze(self, content, filepath=None):
+        '''Count the features of one page, add them to the corpus totals.
+
+        Returns a dict with the page's size and feature counts, and the names
+        of the unsupported tags it uses.
+        '''
+        content = content.replace('\r\n', '\n')
+        size = len(content.encode('utf-8'))
+        lines = content.count('\n') + (content[-1:] not in ('', '\n'))
+        content = '\n' + content + '\n\n'
+        counts = dict((feature, 0) for feature in self.features)
+        unsupported = []
+
+        # like extract_verbatim(): count verbatim sections, then take them
+        # out, so that their content does not count as markup
+        for feature, pattern, trigger in (('code', Patterns.code, '[[code'),
+                                          ('escapes', Patterns.escape, '``'),
+                                          ('math', Patterns.math, '[[math')):
+            if trigger in content:
+                content, counts[feature] = re.subn(pattern, '', content)
+
+        if '=' in content:
+            counts['headings'] = len(re.findall(Patterns.heading, content))
+        if '||' in content:
+            counts['tables'] = len(re.findall(Patterns.table, content))
+        counts['list_items'] = len(re.findall(r'\n *[*#+]+[ \t]', content))
+        counts['variables'] = content.count('{$page}')
+
+        for matchobj in re.finditer(Patterns.tag, content):
+            tag = matchobj.group(1)
+            if tag.startswith('image:'):
+                counts['images'] += 1
+                if 'link="' in tag:
+                    counts['images_with_links'] += 1
+            elif tag.startswith('file:'):
+                counts['file_links'] += 1
+            elif tag.lstrip('@').startswith(('http://', 'https://', 'ftp://')):
+                counts['external_links'] += 1
+            elif tag in ('toc', 'toc|flat'):
+                counts['toc'] += 1
+            elif tag.startswith('#'):
+                counts['anchors'] += 1
+            elif tag.startswith('include '):
+                counts['includes'] += 1
+                unsupported.append('include')
+            elif re.match(Patterns.widget + '$', tag):
+                counts['unsupported'] += 1
+                unsupported.append(tag.split(' ', 1)[0])
+            elif tag != 'WikiText':
+                counts['page_links'] += 1
+
+        counts['unsupported'] += counts['includes']
+        page = {'page': filepath,
+                'bytes': size,
+                'lines': lines,
+                'features': counts,
+                'unsupported': sorted(set(unsupported))}
+
+        self.pages += 1
+        for feature, count in counts.items():
+            self.totals[feature] += count
+        self.totals['bytes'] += page['bytes']
+        self.totals['lines'] += page['lines']
+        for name in unsupported:
+            self.unsupported[name] = self.unsupported.get(name, 0) + 1
+        return page
+
+    def error(self, filepath, exception):
+        '''Count a page that could not be analyzed, return its record.'''
+        self.errors += 1
+        return {'page': filepath, 'error': str(exception)}
+
+    def report(self):
+        '''Corpus-wide totals of all pages analyzed so far.'''
+        return {'pages': self.pages,
+                'errors': self.errors,
+                'totals': dict(self.totals),
+                'unsupported': dict(self.unsupported)}
+
+
+def _pack_pages(buf, pages):
+    '''Write encoded pages to buf: count, offset table, then the data.'''
+    import struct
+    count = len(pages)
+    offsets = [0]
+    for page in pages:
+        offsets.append(offsets[-1] + len(page))
+    struct.pack_into('<Q%dQ' % (count + 1), buf, 0, count, *offsets)
+    pos = 8 * (count + 2)
+    buf[pos:pos + offsets[-1]] = b''.join(pages)
+
+def _packed_size(pages):
+    return 8 * (len(pages) + 2) + sum(len(page) for page in pages)
+
+def _unpack_pages(buf, start=0, end=None, decode=True):
+    '''Read pages [start:end] from a buffer written by _pack_pages().'''
+    import struct
+    count = struct.unpack_from('<Q', buf, 0)[0]
+    if end is None:
+        end = count
+    offsets = struct.unpack_from('<%dQ' % (end - start + 1), buf, 8 * (start + 1))
+    data = 8 * (count + 2)
+    pages = [bytes(buf[data + offsets[i]:data + offsets[i + 1]])
+             for i in range(end - start)]
+    if decode:
+        pages = [page.decode('utf-8') for page in pages]
+    return pages
+
+# state of a convert_parallel() worker process, set up by _parallel_init()
+_parallel_state = {}
+
+def _parallel_init(input_name, options, filepaths):
+    from multiprocessing import shared_memory
+    _parallel_state['input'] = shared_memory.SharedMemory(name=input_name)
+    _parallel_state['options'] = options
+    _parallel_state['filepaths'] = filepaths
+
+def _parallel_convert(task):
+    '''Convert pages [start:end] of the input segment.
+
+    The results are written to a new segment; only its name goes back to
+    the parent, which reads and unlinks it, with the assets and warnings of
+    the pages and the time the conversion took.
+    '''
+    from multiprocessing import shared_memory
+    start, end = task
+    options = _parallel_state['options']
+    # in binary mode, the pages are converted as they are in the segment
+    texts = _unpack_pages(_parallel_state['input'].buf, start, end,
+                          decode=not options.get('binary'))
+    filepaths = _parallel_state['filepaths']
+    if filepaths is not None:
+        filepaths = filepaths[start:end]
+    assets = []
+    warnings = []
+    started = time.time()
+    results = convert_batch(texts, options, filepaths, assets, warnings)
+    seconds = time.time() - started
+    results = [page if isinstance(page, bytes) else page.encode('utf-8') for page in results]
+    output = shared_memory.SharedMemory(create=True, size=_packed_size(results))
+    _pack_pages(output.buf, results)
+    output.close()
+    return output.name, start, end, assets, warnings, seconds
+
+def convert_parallel(texts, options=None, filepaths=None, processes=None, chunksize=None, assets=None,
+                     warnings=None):
+    '''Like convert_batch(), but spread over a pool of worker processes.
+
+    Page contents and converted pages are not pickled through the pool's
+    pipes, but passed in shared memory segments holding an offset table
+    followed by the utf-8 encoded pages. Workers only receive the index
+    ranges of the pages to convert, and send back the names of their
+    result segments.
+
+    options (a ConversionProfile or a dict) and filepaths are handed to
+    every worker once, when the pool is started; with the 'spawn' start
+    method they have to be picklable, so a link_filter has to be a module
+    level function in that case. A ConversionLog in options['log'] stays
+    with the parent, which accounts for the pages, their warnings and the
+    time of their chunk as the results come in. If assets is a list, the
+    asset list of every page is appended to it, and likewise the warnings
+    of every page to warnings, like with convert_batch(). Pages may be str
+    or bytes (utf-8); every converted page has the type of its text.
+    '''
+    import multiprocessing
+    from multiprocessing import shared_memory
+    options = ConversionProfile.of(options)
+    log = options.get('log')
+    if log is not None:
+        options = options.replace(log=None)
+    texts = list(texts)
+    if filepaths is not None:
+        filepaths = list(filepaths)
+    encoded = [text if isinstance(text, bytes) else text.encode('utf-8') for text in texts]
+    if not encoded:
+        return []
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, -(-len(encoded) // (processes * 4)))
+    tasks = [(start, min(start + chunksize, len(encoded)))
+             for start in range(0, len(encoded), chunksize)]
+
+    results = [None] * len(encoded)
+    page_assets = [None] * len(encoded)
+    page_warnings = [None] * len(encoded)
+    source = shared_memory.SharedMemory(create=True, size=_packed_size(encoded))
+    try:
+        _pack_pages(source.buf, encoded)
+        del encoded
+        with multiprocessing.Pool(processes, _parallel_init,
+                                  (source.name, options, filepaths)) as pool:
+            for name, start, end, chunk_assets, chunk_warnings, seconds in pool.imap_unordered(_parallel_convert, tasks):
+                page_assets[start:end] = chunk_assets
+                page_warnings[start:end] = chunk_warnings
+                output = shared_memory.SharedMemory(name=name)
+                try:
+                    results[start:end] = [page if isinstance(texts[i], bytes) else page.decode('utf-8')
+                                          for i, page in enumerate(_unpack_pages(output.buf, decode=False), start)]
+                finally:
+                    output.close()
+                    output.unlink()
+                if log is not None:
+                    log.batch(end - start, seconds)
+                    sizes = [_size(texts[i]) for i in range(start, end)]
+                    for i, size, share in zip(range(start, end), sizes, _batch_shares(seconds, sizes)):
+                        filepath = filepaths[i] if filepaths is not None else None
+                        for kind, fields in page_warnings[i]:
+                            log.warning(filepath, kind, **fields)
+                        log.page(filepath, size, _size(results[i]), share, len(page_warnings[i]))
+    finally:
+        source.close()
+        source.unlink()
+    if assets is not None:
+        assets.extend(page_assets)
+    if warnings is not None:
+        warnings.extend(page_warnings)
+    return results
+
+
+def _watched(filepath):
+    '''Whether filepath may be a page: not an output of ours, not hidden,
+    not an editor backup.'''
+    filename = os.path.basename(filepath)
+    return not (filename.startswith('.') or filename.endswith(('_markdown', '_html', '~', '.tmp')))
+
+def watched_files(paths):
+    '''All pages in paths, which may be files or directories.'''
+    filepaths = []
+    for path in paths:
+        if not os.path.isdir(path):
+            filepaths.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith('.'))
+            filepaths.extend(os.path.join(dirpath, filename)
+                             for filename in sorted(filenames) if _watched(filename))
+    return filepaths
+
+class PollingWatcher:
+    '''Notices changed pages by comparing the modification times and sizes
+    of all files every interval seconds.
+
+    Works everywhere, but costs a stat() per file and interval. See
+    page_watcher().
+    '''
+    def __init__(self, paths, interval=0.5, debounce=0.2):
+        self.paths = list(paths)
+        self.interval = interval
+        self.debounce = debounce
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for filepath in watched_files(self.paths):
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            snapshot[filepath] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _changes(self):
+        snapshot = self.scan()
+        changed = set(filepath for filepath, stat in snapshot.items()
+                      if self.snapshot.get(filepath) != stat)
+        self.snapshot = snapshot
+        return changed
+
+    def wait(self, timeout=None):
+        '''Wait for pages to be written, return the set of their filepaths.
+
+        Once something changed, waits until nothing did for debounce
+        seconds, so that a burst of writes is returned at once. Returns an
+        empty set if nothing changed within timeout seconds.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            if deadline is not None and time.time() >= deadline:
+                return changed
+            time.sleep(self.interval if deadline is None else
+                       max(0, min(self.interval, deadline - time.time())))
+            changed = self._changes()
+        while True:
+            time.sleep(self.debounce)
+            more = self._changes()
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    '''Notices changed pages through Linux inotify, without polling.
+
+    Directories are watched recursively, including ones created later.
+    Raises OSError where inotify is not available; see page_watcher().
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, paths, debounce=0.2):
+        import ctypes
+        import ctypes.util
+        self.paths = list(paths)
+        self.debounce = debounce
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        # watches of directories given (or found below them), which report
+        # every page; the others were added for single files
+        self.recursive = set()
+        self.files = set()
+        for path in self.paths:
+            if os.path.isdir(path):
+                self._add_tree(path)
+            else:
+                # single files: watch their directory, report only them
+                self.files.add(os.path.normpath(path))
+                self._add_directory(os.path.dirname(path) or '.')
+
+    def _add_directory(self, directory):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', directory)
+        self.directories[wd] = directory
+        return wd
+
+    def _add_tree(self, directory):
+        self.recursive.add(self._add_directory(directory))
+        for dirpath, dirnames, _ in os.walk(directory):
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+            for dirname in dirnames:
+                self.recursive.add(self._add_directory(os.path.join(dirpath, dirname)))
+
+    def _read(self, timeout):
+        '''Filepaths of the pages written within timeout seconds.'''
+        import select
+        import struct
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, pos)
+            name = os.fsdecode(data[pos + 16:pos + 16 + length].rstrip(b'\0'))
+            pos += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                # events were lost: report everything
+                changed.update(watched_files(self.paths))
+                continue
+            if wd not in self.directories or not name or not _watched(name):
+                continue
+            filepath = os.path.join(self.directories[wd], name)
+            if mask & self.IN_ISDIR:
+                if wd in self.recursive:
+                    self._add_tree(filepath)
+                    changed.update(watched_files([filepath]))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                if wd in self.recursive or os.path.normpath(filepath) in self.files:
+                    changed.add(filepath)
+        return changed
+
+    def wait(self, timeout=None):
+        '''Like PollingWatcher.wait().'''
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return changed
+            changed = self._read(remaining)
+        while True:
+            more = self._read(self.debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        os.close(self.fd)
+
+def page_watcher(paths, polling=False, interval=0.5, debounce=0.2):
+    '''An InotifyWatcher for paths where possible, else a PollingWatcher.'''
+    if not polling:
+        try:
+            return InotifyWatcher(paths, debounce)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return PollingWatcher(paths, interval, debounce)
+
+
 if __name__ == '__main__':
     s = Starter()
     s.start()
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Differential harness: runs the reference converter and a candidate engine
+over the same pages, diffs their output and compares their speed.
+
+The reference is the page converter of the output format (Markdown by
+default), page by page, in str mode.
+Pages come from directories of real Wikispaces pages, from a synthetic
+generator and from a fuzzer mutating both.
+'''
+
+import difflib
+import random
+import sys
+import time
+
+import wstomdconverter
+
+
+def _run_page(text, filepath, options, binary=False):
+    options = wstomdconverter.ConversionProfile.of(options)
+    if options['binary'] != binary:
+        options = options.replace(binary=binary)
+    return wstomdconverter.converter_class(options)(filepath, options, content=text).run()
+
+def reference_engine(text, filepath, options):
+    return _run_page(text, filepath, options)
+
+def bytes_engine(text, filepath, options):
+    return _run_page(text, filepath, options, binary=True)
+
+def batch_engine(texts, filepaths, options):
+    return wstomdconverter.convert_batch(texts, options, filepaths)
+
+def parallel_engine(texts, filepaths, options):
+    return wstomdconverter.convert_parallel(texts, options, filepaths)
+
+# engines converting one page at a time: engine(text, filepath, options)
+PAGE_ENGINES = {'reference': reference_engine,
+                'bytes': bytes_engine}
+# engines converting all pages at once: engine(texts, filepaths, options)
+BATCH_ENGINES = {'batch': batch_engine,
+                 'parallel': parallel_engine}
+
+
+# pieces of Wikispaces markup the synthetic pages and the fuzzer are made of
+FRAGMENTS = ['= Heading =', '== Subheading ==', '=== Deep ===',
+             '* item', '** nested item', '# ordered', '## nested ordered', '#* mixed',
+             '//italics//', '**bold**', '__underline__', '{{monospaced}}',
+             '[[code]]x = 1[[code]]', '[[code format="python"]]\nprint(1)\n[[code]]',
+             '``escaped **stuff**``', '[[math]]a^2 + b^2[[math]]',
+             '[[image:picture.png width="20" height="30" caption="a caption" link="http://example.com"]]',
+             '[[image:picture.gif align="right"]]',
+             '[[file:document.pdf]]', '[[file:paper.tex|a tex file]]',
+             '[[http://example.com|a link]]', '[[https://example.com]]', '[[ftp://example.com]]',
+             '[[Some Page]]', '[[Some Page|with text]]', '[[toc]]', '[[toc|flat]]', '[[#anchor]]',
+             '[[include page="other"]]', '{$page}', '[[WikiText]]',
+             '||~ head 1 ||= head 2 ||', '|| cell || cell ||', '||> right || left ||',
+             'Plain text.', 'A url: http://example.com/some//path', 'Umlauts \xe4\xf6\xfc, 漢字 and \U0001f600.']
+# fragments of markup the fuzzer mixes in, unbalanced on purpose
+NOISE = ['[[', ']]', '{{', '}}', '__', '//', '||', '``', '=', '*', '#', '|', '"',
+         '[[code]]', '[[math]]', '\r\n', '\t', ' ', '\n', '\n\n', '\x00']
+
+
+def synthetic_pages(count, rng):
+    '''Random pages made of well-formed markup fragments.'''
+    pages = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(0, 30)):
+            parts.append(rng.choice(FRAGMENTS))
+            parts.append(rng.choice(['\n', '\n', '\n\n', ' ', '']))
+        pages.append(''.join(parts))
+    return pages
+
+def fuzz_pages(corpus, count, rng):
+    '''Pages from the corpus (or from scratch) with random edits.'''
+    pages = []
+    for _ in range(count):
+        page = rng.choice(corpus) if corpus else ''
+        for _ in range(rng.randint(1, 10)):
+            pos = rng.randint(0, len(page))
+            edit = rng.random()
+            if edit < 0.4:
+                page = page[:pos] + rng.choice(NOISE) + page[pos:]
+            elif edit < 0.7:
+                page = page[:pos] + rng.choice(FRAGMENTS) + page[pos:]
+            else:
+                page = page[:pos] + page[pos + rng.randint(1, 20):]
+        pages.append(page)
+    return pages
+
+def read_corpus(directories):
+    '''(filepath, content) of all pages below the given directories.
+
+    The pages are the files watch mode would convert: converted outputs
+    of either format, hidden files and editor backups are left out.
+    '''
+    return [(filepath, open(filepath, encoding='utf-8', errors='replace').read())
+            for filepath in wstomdconverter.watched_files(directories)]
+
+
+def _timed_pages(engine, texts, filepaths, options):
+    outputs, seconds = [], []
+    for text, filepath in zip(texts, filepaths):
+        started = time.perf_counter()
+        outputs.append(engine(text, filepath, options))
+        seconds.append(time.perf_counter() - started)
+    return outputs, seconds
+
+def compare(texts, filepaths, candidate, options=None):
+    '''Convert all pages with the reference and the candidate engine.
+
+    candidate is a name from PAGE_ENGINES or BATCH_ENGINES, or a function
+    taking (text, filepath, options). Returns a list with a dict per page:
+    filepath, both outputs, whether they are the same and the time each
+    engine took. Batch engines only have a total time, which is spread over
+    the pages by size. options is a dict or ConversionProfile, made into a
+    profile once for all engines.
+    '''
+    options = wstomdconverter.ConversionProfile.of(options)
+    reference, reference_seconds = _timed_pages(reference_engine, texts, filepaths, options)
+    if candidate in BATCH_ENGINES:
+        started = time.perf_counter()
+        outputs = BATCH_ENGINES[candidate](texts, filepaths, options)
+        total = time.perf_counter() - started
+        size = float(sum(len(text) + 1 for text in texts)) or 1.0
+        seconds = [total * (len(text) + 1) / size for text in texts]
+    else:
+        engine = PAGE_ENGINES.get(candidate, candidate)
+        outputs, seconds = _timed_pages(engine, texts, filepaths, options)
+
+    results = []
+    for i, filepath in enumerate(filepaths):
+        results.append({'filepath': filepath,
+                        'same': reference[i] == outputs[i],
+                        'reference': reference[i],
+                        'candidate': outputs[i],
+                        'reference_seconds': reference_seconds[i],
+                        'candidate_seconds': seconds[i]})
+    return results
+
+def report(results, outstream, show=5, verbose=False):
+    '''Print speedups and the diffs of (up to show) diverging pages.
+
+    Returns the number of diverging pages.
+    '''
+    diverging = [result for result in results if not result['same']]
+    if verbose:
+        for result in results:
+            outstream.write('{:<40} {:>10.6f} {:>10.6f} {:>7.2f}x {}\n'.format(
+                    str(result['filepath']), result['reference_seconds'], result['candidate_seconds'],
+                    result['reference_seconds'] / max(result['candidate_seconds'], 1e-9),
+                    'ok' if result['same'] else 'DIFF'))
+    for result in diverging[:show]:
+        outstream.writelines(difflib.unified_diff(
+                result['reference'].splitlines(True), result['candidate'].splitlines(True),
+                '{} (reference)'.format(result['filepath']), '{} (candidate)'.format(result['filepath'])))
+        outstream.write('\n')
+    reference_total = sum(result['reference_seconds'] for result in results)
+    candidate_total = sum(result['candidate_seconds'] for result in results)
+    outstream.write('{} pages, {} diverging, reference {:.3f}s, candidate {:.3f}s, speedup {:.2f}x\n'.format(
+            len(results), len(diverging), reference_total, candidate_total,
+            reference_total / max(candidate_total, 1e-9)))
+    return len(diverging)
+
+def load_engine(spec):
+    '''An engine name, or module:function for a page engine of your own.'''
+    if spec in PAGE_ENGINES or spec in BATCH_ENGINES:
+        return spec
+    import importlib
+    modulename, _, functionname = spec.partition(':')
+    if not functionname:
+        raise ValueError("unknown engine '{}'".format(spec))
+    return getattr(importlib.import_module(modulename), functionname)
+
+
+def main(argv=None):
+    import optparse
+    parser = optparse.OptionParser(
+            description="Convert pages with the reference converter and a candidate engine, report diverging output and speedups.",
+            usage="%prog [options] [directory ...]")
+    parser.add_option("-c", "--candidate", dest="candidate", help="Candidate engine: {} or module:function taking (text, filepath, options). [default: %default]".format(', '.join(sorted(list(PAGE_ENGINES) + list(BATCH_ENGINES)))))
+    parser.add_option("-o", "--format", dest="format", choices=sorted(wstomdconverter.FORMATS), help="Output format. [default: %default]")
+    parser.add_option("-s", "--synthetic", type="int", dest="synthetic", help="Number of synthetic pages to add. [default: %default]")
+    parser.add_option("-z", "--fuzz", type="int", dest="fuzz", help="Number of fuzzed pages to add. [default: %default]")
+    parser.add_option("-r", "--seed", type="int", dest="seed", help="Random seed for synthetic and fuzzed pages. [default: %default]")
+    parser.add_option("--show", type="int", dest="show", help="Number of diverging pages to print diffs for. [default: %default]")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", help="Print timings for every page. [default: %default]")
+    parser.set_defaults(format='markdown', candidate='bytes', synthetic=200, fuzz=200, seed=0, show=5, verbose=False)
+    (options, args) = parser.parse_args(argv)
+
+    rng = random.Random(options.seed)
+    corpus = read_corpus(args)
+    synthetic = synthetic_pages(options.synthetic, rng)
+    fuzzed = fuzz_pages([text for _, text in corpus] + synthetic, options.fuzz, rng)
+    filepaths = ([filepath for filepath, _ in corpus]
+                 + ['synthetic/{}'.format(i) for i in range(len(synthetic))]
+                 + ['fuzz/{}'.format(i) for i in range(len(fuzzed))])
+    texts = [text for _, text in corpus] + synthetic + fuzzed
+
+    results = compare(texts, filepaths, load_engine(options.candidate), {'format': options.format})
+    return 1 if report(results, sys.stdout, options.show, options.verbose) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,391 @@
+#!/usr/bin/python
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''The converter as a local HTTP service, and a load generator for it.
+
+POST a page (utf-8) to /convert and get the converted page back; the query
+string may set format and toc, e.g. /convert?format=html&toc=1. GET
+/metrics returns the counters of the service's ConversionLog, /health
+returns "ok".
+
+The load generator replays a corpus (directories of pages, synthetic pages
+and pages of growing size) against the service at a given concurrency and
+reports latency percentiles, throughput, latency by page size and the
+service's memory over time. Without --url, it starts the service in a
+child process on a free localhost port, so that its memory can be sampled
+on its own.
+'''
+
+import http.client
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import wstomdconverter
+import wstomddiff
+
+
+def _flag(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    '''Converts the pages POSTed to /convert, see the module docstring.'''
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, which Nagle's algorithm would
+    # hold back for the client's delayed ACK
+    disable_nagle_algorithm = True
+    quiet = True
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/metrics':
+            self.respond(200, self.server.log.metrics(), 'text/plain; version=0.0.4')
+        elif path == '/health':
+            self.respond(200, 'ok\n')
+        else:
+            self.respond(404, 'not found\n')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        content = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if url.path != '/convert':
+            self.respond(404, 'not found\n')
+            return
+        try:
+            profile = self.server.profile_for(url.query)
+        except (ValueError, KeyError) as e:
+            self.respond(400, '{}\n'.format(e))
+            return
+        if not profile['binary']:
+            try:
+                content = content.decode('utf-8')
+            except UnicodeDecodeError:
+                self.respond(400, 'pages have to be utf-8\n')
+                return
+        started = time.perf_counter()
+        result = wstomdconverter.converter_class(profile)(None, profile, content=content).run()
+        seconds = time.perf_counter() - started
+        self.respond(200, result, 'text/html' if profile['format'] == 'html' else 'text/markdown',
+                     {'X-Conversion-Seconds': '{:.6f}'.format(seconds)})
+
+    def respond(self, status, body, content_type='text/plain', headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ConversionServer(ThreadingHTTPServer):
+    '''A threading HTTP server converting pages with one profile.
+
+    The profiles for the options requests come with are made from the
+    server's profile once and kept.
+    '''
+    daemon_threads = True
+    # query parameters a request may set
+    query_options = {'format': str, 'toc': _flag}
+
+    def __init__(self, address, options=None, handler=ConversionHandler):
+        ThreadingHTTPServer.__init__(self, address, handler)
+        profile = wstomdconverter.ConversionProfile.of(options)
+        self.log = profile.get('log')
+        if self.log is None:
+            self.log = wstomdconverter.ConversionLog()
+            profile = profile.replace(log=self.log)
+        self.profile = profile
+        # by the normalized options, so there is one per valid combination
+        self.profiles = {(): profile}
+
+    def profile_for(self, query):
+        changes = {}
+        for key, values in parse_qs(query, strict_parsing=bool(query)).items():
+            if key not in self.query_options:
+                raise ValueError("unknown option '{}'".format(key))
+            changes[key] = self.query_options[key](values[-1])
+        key = tuple(sorted(changes.items()))
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles[key] = self.profile.replace(**changes)
+        return profile
+
+
+def growing_pages(count, rng, start=1024):
+    '''Synthetic pages of start, twice start, four times start, ... characters.'''
+    pages = []
+    for i in range(count):
+        size = start << i
+        parts = []
+        length = 0
+        while length < size:
+            part = wstomddiff.synthetic_pages(1, rng)[0]
+            parts.append(part)
+            length += len(part) + 1
+        pages.append('\n'.join(parts))
+    return pages
+
+def percentile(values, percent):
+    '''The nearest-rank percentile of sorted values, None if there are none.'''
+    if not values:
+        return None
+    rank = max(int(-(-percent * len(values) // 100)), 1)
+    return values[rank - 1]
+
+def rss(pid):
+    '''Resident memory of process pid in bytes, None where it can not be read.'''
+    try:
+        with open('/proc/{}/statm'.format(pid)) as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def run_load(url, pages, concurrency=4, requests=None, duration=None, pid=None, interval=0.5):
+    '''Replay pages against the service at url, from concurrency threads.
+
+    Pages are sent round robin, until requests pages were sent (by default,
+    every page once) or duration seconds are over. Every thread keeps its
+    connection open. pid is the process of the service, whose memory is
+    sampled every interval seconds.
+
+    Returns a dict: samples, a (start, seconds, page size, status) tuple
+    per request, memory, a list of (seconds since start, bytes), and the
+    elapsed seconds.
+    '''
+    target = urlsplit(url)
+    path = (target.path.rstrip('/') or '') + '/convert' + ('?' + target.query if target.query else '')
+    if requests is None and duration is None:
+        requests = len(pages)
+    encoded = [page.encode('utf-8') for page in pages]
+    counter = iter(range(requests)) if requests is not None else itertools.count()
+    lock = threading.Lock()
+    samples = []
+    memory = []
+    done = threading.Event()
+    started = time.perf_counter()
+
+    def worker():
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+        own = []
+        try:
+            while not done.is_set():
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    break
+                body = encoded[i % len(encoded)]
+                sent = time.perf_counter()
+                try:
+                    connection.request('POST', path, body, {'Content-Type': 'text/plain; charset=utf-8'})
+                    response = connection.getresponse()
+                    response.read()
+                    status = response.status
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    status = None
+                own.append((sent - started, time.perf_counter() - sent, len(body), status))
+        finally:
+            connection.close()
+            with lock:
+                samples.extend(own)
+
+    def sampler():
+        while True:
+            size = rss(pid)
+            if size is not None:
+                memory.append((time.perf_counter() - started, size))
+            if done.wait(interval):
+                break
+        size = rss(pid)
+        if size is not None:
+            memory.append((time.perf_counter() - started, size))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    monitor = threading.Thread(target=sampler) if pid is not None else None
+    if monitor is not None:
+        monitor.start()
+    for thread in threads:
+        thread.start()
+    if duration is not None:
+        deadline = started + duration
+        while any(thread.is_alive() for thread in threads) and time.perf_counter() < deadline:
+            time.sleep(min(0.05, max(deadline - time.perf_counter(), 0)))
+        done.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    if monitor is not None:
+        monitor.join()
+    samples.sort()
+    return {'samples': samples, 'memory': memory, 'seconds': elapsed}
+
+def summarize(result):
+    '''Latency percentiles, throughput and latency by page size of a load run.'''
+    samples = result['samples']
+    ok = [sample for sample in samples if sample[3] == 200]
+    latencies = sorted(sample[1] for sample in ok)
+    elapsed = result['seconds'] or 1e-9
+    summary = {'requests': len(samples),
+               'errors': len(samples) - len(ok),
+               'seconds': round(result['seconds'], 6),
+               'requests_per_second': round(len(ok) / elapsed, 3),
+               'bytes_per_second': round(sum(sample[2] for sample in ok) / elapsed, 1),
+               'latency': dict(('p{}'.format(p), percentile(latencies, p)) for p in (50, 95, 99)),
+               'memory': [(round(t, 3), size) for t, size in result['memory']]}
+    summary['latency']['max'] = latencies[-1] if latencies else None
+    # pages in buckets of up to 1, 4, 16, ... KB
+    buckets = {}
+    for sample in ok:
+        limit = 1024
+        while sample[2] > limit:
+            limit *= 4
+        buckets.setdefault(limit, []).append(sample[1])
+    summary['by_size'] = [{'up_to_bytes': limit, 'requests': len(values),
+                           'p50': percentile(sorted(values), 50), 'p95': percentile(sorted(values), 95)}
+                          for limit, values in sorted(buckets.items())]
+    return summary
+
+def report(summary, outstream):
+    def ms(seconds):
+        return '{:.2f}ms'.format(seconds * 1000) if seconds is not None else '-'
+    outstream.write('{} requests, {} errors in {:.3f}s: {:.1f} requests/s, {:.1f} KB/s\n'.format(
+            summary['requests'], summary['errors'], summary['seconds'],
+            summary['requests_per_second'], summary['bytes_per_second'] / 1024))
+    latency = summary['latency']
+    outstream.write('latency p50 {} p95 {} p99 {} max {}\n'.format(
+            ms(latency['p50']), ms(latency['p95']), ms(latency['p99']), ms(latency['max'])))
+    for bucket in summary['by_size']:
+        outstream.write('  pages up to {:>8} bytes: {:>6} requests, p50 {:>10} p95 {:>10}\n'.format(
+                bucket['up_to_bytes'], bucket['requests'], ms(bucket['p50']), ms(bucket['p95'])))
+    if summary['memory']:
+        outstream.write('service memory (RSS) over time:\n')
+        for t, size in summary['memory']:
+            outstream.write('  {:>8.2f}s {:>8.1f} MB\n'.format(t, size / 1048576.0))
+
+def start_service(options=None):
+    '''Start the service in a child process on a free localhost port.
+
+    Returns the process and the URL it serves.
+    '''
+    import subprocess
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', '0']
+    if options:
+        for key, value in sorted(options.items()):
+            command.extend(['--option', '{}={}'.format(key, value)])
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line.startswith('listening on '):
+        process.kill()
+        raise RuntimeError('the service did not start')
+    return process, line[len('listening on '):].strip()
+
+def serve(host='127.0.0.1', port=8080, options=None, quiet=True):
+    server = ConversionServer((host, port), options)
+    server.RequestHandlerClass.quiet = quiet
+    # the first line tells start_service() where to connect
+    print('listening on http://{}:{}'.format(*server.server_address[:2]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    import json
+    import optparse
+    parser = optparse.OptionParser(
+            description="Run the converter as a local HTTP service (--serve), or replay pages against one and report latency, throughput and memory.",
+            usage="%prog [options] [directory ...]")
+    parser.add_option("--serve", action="store_true", dest="serve", help="Run the service instead of the load generator. [default: %default]")
+    parser.add_option("--host", dest="host", help="Address the service listens on. [default: %default]")
+    parser.add_option("-p", "--port", type="int", dest="port", help="Port the service listens on, 0 for a free one. [default: %default]")
+    parser.add_option("--option", action="append", dest="option", help="Conversion option of the service, as key=value (format, toc, filelocation, ...); may be repeated.")
+    parser.add_option("-c", "--config", dest="config", help="Read the service's conversion options from this file, see wstomdconverter.py --config. [default: %default]")
+    parser.add_option("-u", "--url", dest="url", help="URL of a running service, with an optional query string like ?format=html; without, one is started. [default: %default]")
+    parser.add_option("--pid", type="int", dest="pid", help="Process id of the service at --url, to sample its memory. [default: %default]")
+    parser.add_option("-n", "--concurrency", type="int", dest="concurrency", help="Number of concurrent connections. [default: %default]")
+    parser.add_option("-r", "--requests", type="int", dest="requests", help="Number of requests; by default, every page once. [default: %default]")
+    parser.add_option("-t", "--duration", type="float", dest="duration", help="Send requests for this many seconds instead. [default: %default]")
+    parser.add_option("-s", "--synthetic", type="int", dest="synthetic", help="Number of synthetic pages to add. [default: %default]")
+    parser.add_option("-g", "--grow", type="int", dest="grow", help="Number of synthetic pages of growing size to add: 1 KB, 2 KB, 4 KB, ... [default: %default]")
+    parser.add_option("--seed", type="int", dest="seed", help="Random seed for synthetic pages. [default: %default]")
+    parser.add_option("-i", "--interval", type="float", dest="interval", help="Seconds between memory samples. [default: %default]")
+    parser.add_option("-j", "--json", dest="json_file", help="Also write the summary to this file as JSON. [default: %default]")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", help="Log every request of the service. [default: %default]")
+    parser.set_defaults(serve=False, host='127.0.0.1', port=8080, option=[], config=None, url=None, pid=None,
+                        concurrency=4, requests=None, duration=None, synthetic=200, grow=8, seed=0,
+                        interval=0.5, json_file=None, verbose=False)
+    (options, args) = parser.parse_args(argv)
+
+    conversion = {}
+    try:
+        if options.config is not None:
+            conversion.update(wstomdconverter.ConversionProfile.read(options.config))
+        for option in options.option:
+            key, sep, value = option.partition('=')
+            if not sep:
+                parser.error("--option expects key=value, not '{}'".format(option))
+            conversion[key] = _flag(value) if key in wstomdconverter.ConversionProfile.flags else value
+        wstomdconverter.ConversionProfile(conversion)
+    except (OSError, ImportError, AttributeError, ValueError) as e:
+        parser.error(str(e))
+
+    if options.serve:
+        serve(options.host, options.port, conversion, quiet=not options.verbose)
+        return 0
+
+    rng = random.Random(options.seed)
+    pages = ([text for _, text in wstomddiff.read_corpus(args)]
+             + wstomddiff.synthetic_pages(options.synthetic, rng)
+             + growing_pages(options.grow, rng))
+    if not pages:
+        parser.error("no pages to send")
+
+    process = None
+    url, pid = options.url, options.pid
+    if url is None:
+        process, url = start_service(conversion)
+        pid = process.pid
+    try:
+        result = run_load(url, pages, options.concurrency, options.requests, options.duration,
+                          pid, options.interval)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    summary = summarize(result)
+    report(summary, sys.stdout)
+    if options.json_file is not None:
+        with open(options.json_file, 'w') as outfile:
+            json.dump(summary, outfile, indent=1, sort_keys=True)
+    return 1 if summary['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())